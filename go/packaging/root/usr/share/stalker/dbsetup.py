@@ -64,23 +64,35 @@ def create_db(dbname):
 
 
 def create_table_indexes(dbname):
-    """create all necessary table indexes for stalkerd in database"""
+    """create all necessary table indexes for stalkerd in database. indexes
+    are either a field name or a (name, [fields]) compound index"""
     tables = get_tables(dbname)
-    tables_and_indexes = {"hosts": ["hostname"],
+    tables_and_indexes = {"hosts": ["hostname", "ip"],
                           "checks": ["in_maintenance", "next", "pending",
-                                     "status", "suspended"],
+                                     "status", "suspended", "ip", "hostname",
+                                     ("hostname_status",
+                                      ["hostname", "status"])],
                           "users": ["username"],
-                          "state_log": ["hostname", "check"],
+                          "state_log": ["hostname", "check",
+                                        ("hostname_check_last",
+                                         ["hostname", "check", "last"])],
                           "notifications": ["cid", "hostname", "check"],
-                          "notes": ["cid", "hostname", "check"]}
+                          "notes": ["cid", "hostname", "check",
+                                    ("hostname_ts", ["hostname", "ts"])]}
 
     for table, indexes in tables_and_indexes.iteritems():
         if table not in tables:
             print r.db(dbname).table_create(table).run()
         table_indexes = get_table_indexes(dbname, table)
         for index in indexes:
-            if index not in table_indexes:
+            if isinstance(index, tuple):
+                name, fields = index
+                if name not in table_indexes:
+                    print r.db(dbname).table(table).index_create(
+                        name, [r.row[field] for field in fields]).run()
+            elif index not in table_indexes:
                 print r.db(dbname).table(table).index_create(index).run()
+        r.db(dbname).table(table).index_wait().run()
 
 
 def main():
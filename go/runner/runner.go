@@ -136,7 +136,7 @@ func New(conf string, opts Opts) *Runner {
 		swg:      &sync.WaitGroup{},
 	}
 	sr.checkTransport = &http.Transport{
-		TLSClientConfig:       &tls.Config{InsecureSkipVerify: true},
+		TLSClientConfig:       &tls.Config{InsecureSkipVerify: true, ClientSessionCache: tls.NewLRUClientSessionCache(0)},
 		TLSHandshakeTimeout:   10 * time.Second,
 		MaxIdleConnsPerHost:   1,
 		ResponseHeaderTimeout: 10 * time.Second,
@@ -1,13 +1,344 @@
 import os
+import re
 import json
 import ast
-from random import randint
-from eventlet import wsgi, sleep
-from eventlet.green import subprocess, urllib2
+import shlex
+import errno
+import signal
+from hashlib import sha1
+from bisect import bisect_left
+from collections import deque
+from time import time
+from random import randint, uniform
+from eventlet import wsgi, sleep, GreenPool
+from eventlet.event import Event
+from eventlet.queue import LightQueue
+from eventlet.semaphore import Semaphore
+from eventlet.hubs import trampoline
+from eventlet import tpool
+from eventlet.green import subprocess, urllib2, ssl
 from socket import getfqdn
 import fcntl
+import ctypes
+import ctypes.util
+import platform
+import resource
 import eventlet
-from stalkerutils.stalkerutils import Daemon, FileLikeLogger, readconf, get_logger
+from stalkerutils.stalkerutils import Daemon, FileLikeLogger, readconf, \
+    get_logger, StatsdEvent, TRUE_VALUES
+
+# per check settings that get sent to stalkerweb when registering
+REGISTER_FIELDS = ('cmd', 'args', 'env', 'interval', 'priority', 'follow_up')
+
+# label=value[uom];[warn];[crit];[min];[max]
+PERFDATA_RE = re.compile(r"('[^']+'|[^\s=']+)=([-+]?[0-9.]+)([^;\s]*)"
+                         r"(?:;([^;\s]*))?(?:;([^;\s]*))?"
+                         r"(?:;([^;\s]*))?(?:;([^;\s]*))?")
+METRIC_NAME_RE = re.compile(r'[^A-Za-z0-9_-]')
+
+# ioprio_set(2) has no libc wrapper, so we need the raw syscall number
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289,
+                       'aarch64': 30, 'armv7l': 314, 'ppc64le': 273,
+                       's390x': 282}
+IOPRIO_CLASSES = {'none': 0, 'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+RLIMITS = (('rlimit_as', resource.RLIMIT_AS),
+           ('rlimit_cpu', resource.RLIMIT_CPU),
+           ('rlimit_nofile', resource.RLIMIT_NOFILE))
+
+
+def _perf_value(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value  # a range like 10:20 or @5:10
+
+
+def parse_perfdata(output):
+    """Parse the nagios perfdata in a checks output: whatever follows a |
+    on the first line, plus every line after the | that ends the long
+    text output.
+
+    :returns: list of dicts with label, value, unit, warn, crit, min, max
+    """
+    if '|' not in output:
+        return []
+    perfdata = []
+    for part in output.split('\n', 1):
+        if '|' in part:
+            perfdata.append(part.split('|', 1)[1])
+    perfdata = ' '.join(perfdata)
+    metrics = []
+    for m in PERFDATA_RE.finditer(perfdata):
+        try:
+            value = float(m.group(2))
+        except ValueError:
+            continue
+        metrics.append({'label': m.group(1).strip("'"), 'value': value,
+                        'unit': m.group(3), 'warn': _perf_value(m.group(4)),
+                        'crit': _perf_value(m.group(5)),
+                        'min': _perf_value(m.group(6)),
+                        'max': _perf_value(m.group(7))})
+    return metrics
+
+
+class AgentHttpProtocol(wsgi.HttpProtocol):
+    """HttpProtocol that counts new connections and requests that reuse an
+    already open (keep-alive) connection"""
+
+    counters = None
+
+    def setup(self):
+        wsgi.HttpProtocol.setup(self)
+        self.requests_served = 0
+        self.counters['connections'] += 1
+
+    def get_environ(self):
+        self.requests_served += 1
+        if self.requests_served > 1:
+            self.counters['reused_connections'] += 1
+        return wsgi.HttpProtocol.get_environ(self)
+
+
+class TLSListener(object):
+    """Listening socket that does TLS for each accepted connection using one
+    shared SSLContext, so session tickets and the session cache work across
+    connections."""
+
+    def __init__(self, sock, context):
+        self.sock = sock
+        self.context = context
+
+    def accept(self):
+        conn, addr = self.sock.accept()
+        # the handshake happens on first read so we don't hold up accept()
+        return (self.context.wrap_socket(conn, server_side=True,
+                                         do_handshake_on_connect=False),
+                addr)
+
+    def __getattr__(self, attr):
+        return getattr(self.sock, attr)
+
+
+def parse_size(value):
+    """'512M' -> 536870912, plain numbers are bytes"""
+    value = value.strip().upper()
+    for i, suffix in enumerate('KMGT'):
+        if value.endswith(suffix):
+            return int(value[:-1]) * 1024 ** (i + 1)
+    return int(value)
+
+
+class ChildLimits(object):
+    """A preexec_fn that drops a check into its own session and applies
+    its nice level, io priority and rlimits right before exec. Everything
+    is worked out up front so the child only makes syscalls."""
+
+    _libc = None
+
+    def __init__(self, nice=0, ionice_class=None, ionice_level=4,
+                 rlimits=None):
+        self.nice = nice
+        self.ioprio = None
+        self.syscall = None
+        if ionice_class and ionice_class != 'none':
+            if ionice_class not in IOPRIO_CLASSES:
+                raise ValueError('unknown ionice_class %s' % ionice_class)
+            if not 0 <= ionice_level <= 7:
+                raise ValueError('ionice_level should be 0-7')
+            self.syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+            if self.syscall is None:
+                raise ValueError('ionice not supported on %s' %
+                                 platform.machine())
+            if ChildLimits._libc is None:
+                ChildLimits._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                                use_errno=True)
+            self.ioprio = ((IOPRIO_CLASSES[ionice_class] <<
+                            IOPRIO_CLASS_SHIFT) | ionice_level)
+        self.rlimits = []
+        for res, value in sorted((rlimits or {}).items()):
+            if value is None:
+                continue
+            hard = resource.getrlimit(res)[1]
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            self.rlimits.append((res, value))
+
+    def __call__(self):
+        os.setsid()
+        if self.nice:
+            os.nice(self.nice)
+        if self.ioprio is not None:
+            self._libc.syscall(self.syscall, IOPRIO_WHO_PROCESS, 0,
+                               self.ioprio)
+        for res, value in self.rlimits:
+            resource.setrlimit(res, (value, value))
+
+    def __eq__(self, other):
+        return (isinstance(other, ChildLimits) and
+                (self.nice, self.ioprio, self.rlimits) ==
+                (other.nice, other.ioprio, other.rlimits))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'ChildLimits(nice=%s, ioprio=%s, rlimits=%s)' % (
+            self.nice, self.ioprio, self.rlimits)
+
+
+def reap(p):
+    """Wait for a Popen'd child without blocking the hub and return its
+    resource usage (or None if someone else already reaped it)"""
+    delay = 0.001
+    while True:
+        try:
+            pid, sts, rusage = os.wait4(p.pid, os.WNOHANG)
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                continue
+            if err.errno == errno.ECHILD:
+                p.wait()
+                return None
+            raise
+        if pid == p.pid:
+            p._handle_exitstatus(sts)
+            return rusage
+        sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+def usage_dict(rusage, wall):
+    """What we report about a check processes resource usage"""
+    usage = {'wall': wall}
+    if rusage:
+        usage.update({'cpu': rusage.ru_utime + rusage.ru_stime,
+                      'user': rusage.ru_utime, 'sys': rusage.ru_stime,
+                      'max_rss_kb': rusage.ru_maxrss,
+                      'inblock': rusage.ru_inblock,
+                      'oublock': rusage.ru_oublock})
+    return usage
+
+
+# upper bounds (in seconds) of the check latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class CheckStats(object):
+    """Fixed size execution stats and latency histogram for one check"""
+
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.shed = 0
+        self.queued = 0
+        self.in_flight = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_cpu = 0.0
+        self.max_rss_kb = 0
+        self.inblock = 0
+        self.oublock = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, duration, status, usage=None):
+        self.runs += 1
+        if status != 0:
+            self.failures += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.buckets[bisect_left(LATENCY_BUCKETS, duration)] += 1
+        if usage and 'cpu' in usage:
+            self.total_cpu += usage['cpu']
+            self.max_rss_kb = max(self.max_rss_kb, usage['max_rss_kb'])
+            self.inblock += usage['inblock']
+            self.oublock += usage['oublock']
+
+    def to_dict(self):
+        bounds = [str(x) for x in LATENCY_BUCKETS] + ['+Inf']
+        return {'runs': self.runs, 'failures': self.failures,
+                'errors': self.errors, 'timeouts': self.timeouts,
+                'shed': self.shed, 'queued': self.queued,
+                'in_flight': self.in_flight,
+                'total_time': self.total_time, 'max_time': self.max_time,
+                'total_cpu': self.total_cpu, 'max_rss_kb': self.max_rss_kb,
+                'inblock': self.inblock, 'oublock': self.oublock,
+                'latency': zip(bounds, self.buckets)}
+
+
+class AgentBusy(Exception):
+    """Raised when a check is shed because too many are already running"""
+    pass
+
+
+class HeadTailBuffer(object):
+    """Holds at most limit bytes of whatever gets written to it, keeping
+    the first and last limit/2 bytes and dropping the middle. getvalue()
+    decodes it as utf-8, so characters split by the cut (or output that
+    isn't utf-8 at all) come back as U+FFFD instead of breaking json."""
+
+    def __init__(self, limit):
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head = ''
+        self.tail = deque()
+        self.tail_len = 0
+        self.truncated = False
+
+    def write(self, data):
+        if len(self.head) < self.head_limit:
+            room = self.head_limit - len(self.head)
+            self.head += data[:room]
+            data = data[room:]
+        if not data:
+            return
+        self.tail.append(data)
+        self.tail_len += len(data)
+        while self.tail_len > self.tail_limit:
+            self.truncated = True
+            excess = self.tail_len - self.tail_limit
+            if len(self.tail[0]) <= excess:
+                self.tail_len -= len(self.tail.popleft())
+            else:
+                self.tail[0] = self.tail[0][excess:]
+                self.tail_len -= excess
+
+    def getvalue(self):
+        if self.truncated:
+            value = '%s\n[...truncated...]\n%s' % (self.head,
+                                                   ''.join(self.tail))
+        else:
+            value = self.head + ''.join(self.tail)
+        return value.decode('utf-8', 'replace')
+
+
+def as_bytes(value):
+    """What to write into a HeadTailBuffer for value: unicode as utf-8,
+    anything else as its str()"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def drain(pipe, buf, chunk_size=65536):
+    """Read a pipe until EOF into buf without ever blocking the hub"""
+    fd = pipe.fileno()
+    while True:
+        trampoline(fd, read=True)
+        try:
+            data = os.read(fd, chunk_size)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                continue
+            raise
+        if not data:
+            return
+        buf.write(data)
 
 
 class StalkerAgent(object):
@@ -32,15 +363,59 @@ class StalkerAgent(object):
         self.script_dir = conf.get('script_dir', '/etc/stalker/scripts')
         self.default_interval = int(conf.get('default_interval', '300'))
         self.default_priority = int(conf.get('default_priority', '1'))
+        self.default_max_age = int(conf.get('default_max_age', '0'))
+        self.default_timeout = int(conf.get('default_timeout', '30'))
+        self.default_limits = {'nice': conf.get('default_nice', '0'),
+                               'ionice_class': conf.get('default_ionice_class',
+                                                        'none'),
+                               'ionice_level': conf.get('default_ionice_level',
+                                                        '4')}
+        for key, _ in RLIMITS:
+            self.default_limits[key] = conf.get('default_%s' % key)
+        self.max_output_bytes = int(conf.get('max_output_bytes', '65536'))
+        self.parse_perfdata = conf.get('parse_perfdata',
+                                       'true').lower() in TRUE_VALUES
+        self.forward_perfdata = conf.get('forward_perfdata',
+                                         'false').lower() in TRUE_VALUES
+        self.statsd = StatsdEvent(conf, self.logger, 'stalker.agent.')
+        self.max_inflight = int(conf.get('max_inflight', '20'))
+        self.max_queued = int(conf.get('max_queued', '20'))
+        self.queue_timeout = float(conf.get('queue_timeout', '5'))
+        self.retry_after = int(conf.get('retry_after', '5'))
+        self.reload_interval = int(conf.get('reload_interval', '60'))
+        self.register_backoff = float(conf.get('register_backoff', '1'))
+        self.register_backoff_max = float(conf.get('register_backoff_max',
+                                                   '300'))
+        self.master_retry_after = None
+        self.slots = Semaphore(self.max_inflight)
+        self.queued = 0
+        self.counters = {'ran': 0, 'queued': 0, 'shed': 0, 'timed_out': 0,
+                         'spawn_errors': 0, 'connections': 0,
+                         'reused_connections': 0}
+        self.check_stats = {}
+        self.keepalive = conf.get('keepalive', 'true').lower() in TRUE_VALUES
+        self.keepalive_timeout = int(conf.get('keepalive_timeout', '60'))
+        self.ssl_context = None
+        self.batch_concurrency = int(conf.get('batch_concurrency', '10'))
+        self.push_mode = conf.get('push_mode', 'false').lower() in TRUE_VALUES
+        self.push_interval = int(conf.get('push_interval', '15'))
+        self.push_batch_size = int(conf.get('push_batch_size', '100'))
+        self.push_queue = deque(maxlen=int(conf.get('push_queue_size',
+                                                    '10000')))
         self.scripts = {}
+        self.plugins = {}
+        self.plugin_calls = {}
+        self.inflight = {}
+        self.results = {}
+        self.next_run = {}
         hostname_parts = int(conf.get('hostname_parts', '1'))
         self.hostname = conf.get('hostname', '.'.join(getfqdn().split('.')[:hostname_parts]))
         self.roles = [x.strip() for x in conf.get('roles',
                                                   'server').split(',')]
         if not os.path.exists(self.script_dir):
             raise Exception("No script dir: %s" % self.script_dir)
-        self._build_check_list()
-        self.logger.info('Found checks: %s' % self.scripts)
+        self.scripts = self._build_check_list()
+        self.logger.info('Found checks: %s' % self._registration_checks())
 
     def _parse_env(self, check, string):
         try:
@@ -53,10 +428,14 @@ class StalkerAgent(object):
 
     def _build_check_list(self):
         """Build our list of checks and their config"""
-        self._get_scripts_from_conf()
+        scripts = self._get_scripts_from_conf()
         for i in os.listdir(self.script_dir):
             if self._script_ok(i):
-                self.scripts[i] = self._script_config(i)
+                try:
+                    scripts[i] = self._script_config(i)
+                except ValueError as err:
+                    self.logger.error('Bad config for %s: %s' % (i, err))
+        return scripts
 
     def _script_ok(self, script_name):
         """Verify this is a check script and we have exec perms"""
@@ -75,7 +454,53 @@ class StalkerAgent(object):
         else:
             return False
 
+    def _child_limits(self, sconf):
+        """Build the ChildLimits for a check from its config section,
+        falling back to our default_* settings"""
+        opts = dict(self.default_limits)
+        opts.update((k, v) for k, v in sconf.items() if k in opts)
+        rlimits = {}
+        for key, res in RLIMITS:
+            if opts[key] and opts[key].lower() not in ('none', 'unlimited'):
+                rlimits[res] = parse_size(opts[key])
+        return ChildLimits(nice=int(opts['nice']),
+                           ionice_class=opts['ionice_class'].lower(),
+                           ionice_level=int(opts['ionice_level']),
+                           rlimits=rlimits)
+
+    def _prepare_exec(self, check, shell, sconf):
+        """Work out ahead of time how a check gets exec'd: the argv (or
+        command line if it wants a shell), its environment and the limits
+        it runs under. Checks without env overrides just inherit ours."""
+        check['limits'] = self._child_limits(sconf)
+        if shell:
+            check['argv'] = "%s %s" % (check['cmd'], check['args'])
+        else:
+            check['argv'] = [check['cmd']] + shlex.split(check['args'])
+        check['shell'] = shell
+        if check['env']:
+            check['environ'] = os.environ.copy()
+            check['environ'].update(check['env'])
+        else:
+            check['environ'] = None
+        return check
+
+    def _load_plugin(self, spec):
+        """Import (once) and return the callable for a 'pkg.module:func'
+        plugin spec"""
+        if spec not in self.plugins:
+            modname, _, funcname = spec.partition(':')
+            if not modname or not funcname:
+                raise ValueError('plugin should look like pkg.module:func')
+            module = __import__(modname, fromlist=[funcname])
+            func = getattr(module, funcname)
+            if not callable(func):
+                raise ValueError('%s is not callable' % spec)
+            self.plugins[spec] = func
+        return self.plugins[spec]
+
     def _get_scripts_from_conf(self):
+        scripts = {}
         for check in self.fullconf:
             if not check.startswith('check_'):
                 continue
@@ -83,6 +508,7 @@ class StalkerAgent(object):
                 self.logger.info('%s disabled. skipping.' % check)
                 continue
             cmd = self.fullconf[check].get('cmd')
+            module = self.fullconf[check].get('module')
             args = self.fullconf[check].get('args') or ''
             env = self._parse_env(check, self.fullconf[check].get('env'))
             interval = int(self.fullconf[check].get('interval',
@@ -90,16 +516,43 @@ class StalkerAgent(object):
             priority = int(self.fullconf[check].get('priority',
                                                     self.default_priority))
             follow_up = int(self.fullconf[check].get('follow_up', interval))
-            if not cmd:
+            max_age = int(self.fullconf[check].get('max_age',
+                                                   self.default_max_age))
+            timeout = int(self.fullconf[check].get('timeout',
+                                                   self.default_timeout))
+            if module:
+                try:
+                    self._load_plugin(module)
+                except Exception as err:
+                    self.logger.error('Unable to load plugin %s for %s: %s' %
+                                      (module, check, err))
+                    continue
+                self.logger.info('found %s plugin' % module)
+                scripts[check] = {'cmd': module, 'module': module,
+                                  'args': args, 'env': env,
+                                  'interval': interval,
+                                  'priority': priority,
+                                  'follow_up': follow_up,
+                                  'max_age': max_age,
+                                  'timeout': timeout}
+            elif not cmd:
                 self.logger.warning('No cmd specified for %s skipping' % check)
             elif not os.path.isfile(cmd) or not os.access(cmd, os.X_OK):
                 self.logger.warning('%s cmd not executable or not file' % cmd)
             else:
+                shell = self.fullconf[check].get('shell',
+                                                 'false').lower() in TRUE_VALUES
+                try:
+                    scripts[check] = self._prepare_exec(
+                        {'cmd': cmd, 'args': args, 'env': env,
+                         'interval': interval, 'priority': priority,
+                         'follow_up': follow_up, 'max_age': max_age,
+                         'timeout': timeout}, shell, self.fullconf[check])
+                except ValueError as err:
+                    self.logger.error('Bad config for %s: %s' % (check, err))
+                    continue
                 self.logger.info('found %s check' % cmd)
-                self.scripts[check] = {'cmd': cmd, 'args': args, 'env': env,
-                                       'interval': interval,
-                                       'priority': priority,
-                                       'follow_up': follow_up}
+        return scripts
 
     def _script_config(self, script_name):
         """Check if theres a .cfg for a given script, if so load the config"""
@@ -108,22 +561,88 @@ class StalkerAgent(object):
                                           script_name + '.cfg'))['default']
         else:
             sconf = {}
-        return {'cmd': os.path.join(self.script_dir, script_name),
-                'args': sconf.get('args', ''), 'env': sconf.get('env', ''),
-                'interval': int(sconf.get('interval', self.default_interval)),
-                'priority': int(sconf.get('priority', self.default_priority)),
-                'follow_up': int(sconf.get('follow_up',
-                                           sconf.get('interval',
-                                                     self.default_interval)))}
+        shell = sconf.get('shell', 'false').lower() in TRUE_VALUES
+        check = {'cmd': os.path.join(self.script_dir, script_name),
+                 'args': sconf.get('args', ''),
+                 'env': self._parse_env(script_name, sconf.get('env')),
+                 'interval': int(sconf.get('interval', self.default_interval)),
+                 'priority': int(sconf.get('priority', self.default_priority)),
+                 'follow_up': int(sconf.get('follow_up',
+                                            sconf.get('interval',
+                                                      self.default_interval))),
+                 'max_age': int(sconf.get('max_age', self.default_max_age)),
+                 'timeout': int(sconf.get('timeout', self.default_timeout))}
+        return self._prepare_exec(check, shell, sconf)
+
+    def _registration_checks(self):
+        """The subset of our check config stalkerweb cares about"""
+        checks = {}
+        for script in self.scripts:
+            checks[script] = dict((k, self.scripts[script][k])
+                                  for k in REGISTER_FIELDS
+                                  if k in self.scripts[script])
+        return checks
+
+    def _script_dir_state(self):
+        """A cheap fingerprint of script_dir (names, mtimes, modes, sizes)"""
+        state = []
+        for i in sorted(os.listdir(self.script_dir)):
+            try:
+                st = os.stat(os.path.join(self.script_dir, i))
+            except OSError:
+                continue  # removed while we were looking
+            state.append((i, st.st_mtime, st.st_mode, st.st_size))
+        return state
+
+    def reload_checks(self):
+        """Rebuild our check list in place, returns True if it changed"""
+        scripts = self._build_check_list()
+        if scripts == self.scripts:
+            return False
+        self.scripts = scripts
+        self.results = {}
+        for script in self.check_stats.keys():
+            if script not in scripts:
+                del self.check_stats[script]
+        self.logger.info('Reloaded checks: %s' % self._registration_checks())
+        return True
+
+    def watch_scripts(self):
+        """Reload our checks whenever script_dir changes and re-register
+        with stalkerweb if the checks it knows about changed."""
+        state = self._script_dir_state()
+        while True:
+            sleep(self.reload_interval)
+            try:
+                current = self._script_dir_state()
+                if current == state:
+                    continue
+                state = current
+                registered = self._registration_checks()
+                if not self.reload_checks():
+                    continue
+            except Exception:
+                self.logger.exception('Error reloading checks')
+                continue
+            if self._registration_checks() != registered:
+                self.register()
 
     def notify_master(self):
-        """Send master our config"""
+        """Send master our config, along with a hash of it so master can
+        skip re-registrations that wouldn't change anything. If master
+        tells us to back off (429/503 w/ Retry-After) we remember how long
+        in master_retry_after."""
         target = '%s/register' % (self.master_url)
-        data = json.dumps({'hostname': self.hostname, 'checks': self.scripts,
-                           'roles': self.roles})
+        config = {'hostname': self.hostname,
+                  'checks': self._registration_checks(),
+                  'roles': self.roles}
+        config['config_hash'] = sha1(json.dumps(config,
+                                                sort_keys=True)).hexdigest()
+        data = json.dumps(config)
         req = urllib2.Request(target, data,
                               {'Content-Type': 'application/json'})
         req.add_header("X-REGISTER-KEY", self.register_key)
+        self.master_retry_after = None
         try:
             r = urllib2.urlopen(req)
             if r.code / 200 != 1:
@@ -136,35 +655,340 @@ class StalkerAgent(object):
                 self.logger.info('Notified master: %s %s %d' % (headers, text,
                                                                 r.code))
                 return True
+        except urllib2.HTTPError as err:
+            if err.code in (429, 503):
+                try:
+                    self.master_retry_after = int(
+                        err.info().getheader('Retry-After'))
+                except (TypeError, ValueError):
+                    pass
+            self.logger.error('Error notifying master: %s (retry after %s)' %
+                              (err, self.master_retry_after))
+            return False
         except Exception as err:
             self.logger.error('Error notifying master: %s' % err)
             return False
 
+    def register(self):
+        """Keep trying to notify master until it works. Backs off
+        exponentially (with jitter) between attempts, and waits at least
+        as long as master asked us to via Retry-After."""
+        attempt = 0
+        while not self.notify_master():
+            backoff = min(self.register_backoff_max,
+                          self.register_backoff * 2 ** attempt)
+            delay = uniform(backoff / 2, backoff)
+            if self.master_retry_after:
+                delay += self.master_retry_after
+            attempt = min(attempt + 1, 30)  # 2 ** attempt stays sane
+            self.logger.info('Retrying registration in %.1fs' % delay)
+            sleep(delay)
+
+    def _acquire_slot(self, script):
+        """Wait (briefly) for a free check slot or raise AgentBusy. Returns
+        the checks stats, to hand back to _release_slot later."""
+        stats = self._check_stats(script)
+        if not self.slots.acquire(blocking=False):
+            if self.queued >= self.max_queued:
+                self.counters['shed'] += 1
+                raise AgentBusy()
+            self.counters['queued'] += 1
+            self.queued += 1
+            stats.queued += 1
+            try:
+                acquired = self.slots.acquire(timeout=self.queue_timeout)
+            finally:
+                self.queued -= 1
+                stats.queued -= 1
+            if not acquired:
+                self.counters['shed'] += 1
+                raise AgentBusy()
+        stats.in_flight += 1
+        return stats
+
+    def _release_slot(self, stats):
+        stats.in_flight -= 1
+        self.slots.release()
+
+    def _execute_plugin(self, script):
+        """Call an in-process plugin check in a worker thread and return
+        its status, out and err. A plugin that runs past its timeout is
+        reported as failed, but the thread can't be killed so it keeps its
+        check slot until it returns, and the plugin won't be called again
+        until then."""
+        if script in self.plugin_calls:
+            self.logger.warning('%s still running, not calling it again' %
+                                script)
+            return {'status': 3, 'out': '', 'truncated': False,
+                    'err': 'Previous call of plugin still running'}
+        func = self._load_plugin(self.scripts[script]['module'])
+        args = shlex.split(self.scripts[script]['args'])
+        timeout = self.scripts[script].get('timeout', self.default_timeout)
+        stats = self._acquire_slot(script)
+        self.counters['ran'] += 1
+        started = time()
+        call = eventlet.spawn(tpool.execute, func, args)
+        self.plugin_calls[script] = call
+
+        def finished(gt):
+            self.plugin_calls.pop(script, None)
+            self._release_slot(stats)
+
+        call.link(finished)
+        try:
+            with eventlet.Timeout(timeout):
+                result = call.wait()
+            wall = time() - started
+        except eventlet.Timeout:
+            self.counters['timed_out'] += 1
+            self._check_stats(script).timeouts += 1
+            self.logger.warning('%s timed out after %ds' % (script, timeout))
+            return {'status': 2, 'out': '', 'truncated': False,
+                    'err': 'Check timed out after %ds' % timeout}
+        except Exception as err:
+            self.logger.exception('Error running plugin %s' % script)
+            return {'status': 2, 'out': '', 'truncated': False,
+                    'err': 'Plugin error: %s' % err}
+        try:
+            status = int(result.get('status', 3))
+        except (AttributeError, TypeError, ValueError):
+            self.logger.error('Plugin %s returned %r, expected a dict with '
+                              'an int status' % (script, result))
+            return {'status': 3, 'out': '', 'truncated': False,
+                    'err': 'Plugin returned %s, expected a dict' %
+                    type(result).__name__,
+                    'usage': usage_dict(None, wall)}
+        out = HeadTailBuffer(self.max_output_bytes)
+        err = HeadTailBuffer(self.max_output_bytes)
+        out.write(as_bytes(result.get('out', '')))
+        err.write(as_bytes(result.get('err', '')))
+        return {'status': status,
+                'out': out.getvalue().strip(), 'err': err.getvalue().strip(),
+                'truncated': out.truncated or err.truncated,
+                'usage': usage_dict(None, wall)}
+
+    def _execute_check(self, script):
+        """Execute a check and return its status, out and err. At most
+        max_output_bytes of stdout and of stderr are kept. The check gets
+        killed (along with anything it spawned) if it runs longer than its
+        timeout. Includes the processes resource usage as reported by
+        wait4()."""
+        if 'module' in self.scripts[script]:
+            return self._execute_plugin(script)
+        stats = self._acquire_slot(script)
+        try:
+            started = time()
+            try:
+                p = subprocess.Popen(self.scripts[script]['argv'],
+                                     shell=self.scripts[script]['shell'],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     env=self.scripts[script]['environ'],
+                                     preexec_fn=self.scripts[script][
+                                         'limits'])
+            except OSError:
+                self.counters['spawn_errors'] += 1
+                raise
+            self.counters['ran'] += 1
+            out = HeadTailBuffer(self.max_output_bytes)
+            err = HeadTailBuffer(self.max_output_bytes)
+            readers = [eventlet.spawn(drain, p.stdout, out),
+                       eventlet.spawn(drain, p.stderr, err)]
+            timeout = self.scripts[script].get('timeout',
+                                               self.default_timeout)
+            timed_out = False
+            try:
+                with eventlet.Timeout(timeout):
+                    for reader in readers:
+                        reader.wait()
+                    rusage = reap(p)
+            except eventlet.Timeout:
+                timed_out = True
+                self.counters['timed_out'] += 1
+                self._check_stats(script).timeouts += 1
+                self.logger.warning('%s timed out after %ds' % (script,
+                                                                timeout))
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                for reader in readers:
+                    reader.kill()
+                rusage = reap(p)
+            finally:
+                p.stdout.close()
+                p.stderr.close()
+        finally:
+            self._release_slot(stats)
+        result = {'status': p.returncode, 'out': out.getvalue().strip(),
+                  'err': err.getvalue().strip(),
+                  'truncated': out.truncated or err.truncated,
+                  'usage': usage_dict(rusage, time() - started)}
+        if timed_out:
+            result['status'] = 2
+            result['err'] = ('%s\nCheck timed out after %ds' %
+                             (result['err'], timeout)).strip()
+        return result
+
+    def _forward_metrics(self, script, metrics):
+        """Send a checks perfdata to statsd as gauges in one packet"""
+        gauges = {}
+        for metric in metrics:
+            gauges['%s.%s.%s' % tuple(METRIC_NAME_RE.sub('_', x) for x in
+                                      (self.hostname, script,
+                                       metric['label']))] = metric['value']
+        self.statsd.batch_gauge(gauges, combined=True)
+
+    def _check_stats(self, script):
+        if script not in self.check_stats:
+            self.check_stats[script] = CheckStats()
+        return self.check_stats[script]
+
+    def _timed_execute(self, script):
+        """Execute a check, recording its latency and outcome"""
+        stats = self._check_stats(script)
+        start = time()
+        try:
+            result = self._execute_check(script)
+        except AgentBusy:
+            stats.shed += 1
+            raise
+        except Exception:
+            stats.errors += 1
+            raise
+        stats.record(time() - start, result['status'], result.get('usage'))
+        return result
+
+    def _run_check(self, script):
+        """Run a check, serving a cached result if its younger than the
+        checks max_age and coalescing concurrent calls for the same check
+        onto a single run."""
+        max_age = self.scripts[script].get('max_age', 0)
+        if max_age:
+            cached = self.results.get(script)
+            if cached and time() - cached[0] < max_age:
+                return cached[1]
+        if script in self.inflight:
+            return self.inflight[script].wait()
+        evt = Event()
+        self.inflight[script] = evt
+        try:
+            result = self._timed_execute(script)
+            if self.parse_perfdata:
+                result['metrics'] = parse_perfdata(result['out'])
+                if self.forward_perfdata and result['metrics']:
+                    self._forward_metrics(script, result['metrics'])
+        except Exception as err:
+            evt.send_exception(err)
+            raise
+        finally:
+            del self.inflight[script]
+        if max_age:
+            self.results[script] = (time(), result)
+        evt.send(result)
+        return result
+
+    def stats(self, env, start_response):
+        """Our own counters and per check execution stats"""
+        stats = {'counters': self.counters,
+                 'connections': self.connection_stats(),
+                 'in_flight': self.max_inflight - self.slots.counter,
+                 'queued': self.queued,
+                 'checks': dict((k, v.to_dict()) for k, v in
+                                self.check_stats.iteritems())}
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return ['%s\r\n' % json.dumps(stats)]
+
     def single(self, env, start_response):
         """Process a single a check call"""
         script = env['PATH_INFO'].strip('/')
-        environ = os.environ.copy()
-        environ.update(self.scripts[script]['env'])
-        p = subprocess.Popen("%s %s" % (self.scripts[script]['cmd'],
-                                        self.scripts[script]['args']),
-                             shell=True, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE, env=environ)
-        stouterr = p.communicate()
-        status = {'%s' % script: {'status': p.returncode,
-                                  'out': stouterr[0].strip(),
-                                  'err': stouterr[1].strip()}}
+        status = {'%s' % script: self._run_check(script)}
         start_response('200 OK', [('Content-Type', 'application/json')])
         return ['%s\r\n' % json.dumps(status)]
 
+    def _batch_result(self, script):
+        """Run a check for a batch call, never raising"""
+        if script not in self.scripts:
+            return script, {'status': 2, 'out': '', 'err': 'No such check'}
+        try:
+            return script, self._run_check(script)
+        except AgentBusy:
+            return script, {'status': 2, 'out': '',
+                            'err': 'Agent busy, check shed'}
+        except Exception as err:
+            self.logger.exception('Error running %s' % script)
+            return script, {'status': 2, 'out': '',
+                            'err': 'Error running check: %s' % err}
+
+    def _stream_batch(self, checks):
+        """Yield a json map of check results as the checks complete"""
+        pool = GreenPool(self.batch_concurrency)
+        done = LightQueue()
+
+        def run_all():
+            for script in checks:
+                pool.spawn_n(lambda s: done.put(self._batch_result(s)),
+                             script)
+
+        eventlet.spawn_n(run_all)
+        sep = ''
+        yield '{'
+        for _ in xrange(len(checks)):
+            script, result = done.get()
+            yield '%s%s: %s' % (sep, json.dumps(script), json.dumps(result))
+            sep = ', '
+        yield '}\r\n'
+
+    def batch(self, env, start_response):
+        """Process a batch check call. Expects a json body of
+        {"checks": ["check_a", "check_b"]} or {"checks": "all"}"""
+        try:
+            length = int(env.get('CONTENT_LENGTH') or 0)
+            requested = json.loads(env['wsgi.input'].read(length))['checks']
+        except (ValueError, KeyError, TypeError):
+            start_response('400 Bad Request',
+                           [('Content-Type', 'text/plain')])
+            return ['Invalid batch request\r\n']
+        if requested == 'all':
+            requested = self.scripts.keys()
+        elif not isinstance(requested, list):
+            start_response('400 Bad Request',
+                           [('Content-Type', 'text/plain')])
+            return ['Invalid batch request\r\n']
+        checks = []
+        for script in requested:
+            if not isinstance(script, basestring):
+                start_response('400 Bad Request',
+                               [('Content-Type', 'text/plain')])
+                return ['Invalid batch request\r\n']
+            if script not in checks:
+                checks.append(script)
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return self._stream_batch(checks)
+
     def handle_request(self, env, start_response):
         if env.get('HTTP_X_CHECK_KEY') != self.check_key:
             start_response('401 Unauthorized',
                            [('Content-Type', 'text/plain')])
             return ['Unauthorized\r\n']
-        if env['PATH_INFO'].startswith('/check_'):
+        if env['PATH_INFO'].rstrip('/') == '/_stats':
+            return self.stats(env, start_response)
+        elif env['PATH_INFO'].rstrip('/') == '/checks':
+            if env['REQUEST_METHOD'] != 'POST':
+                start_response('405 Method Not Allowed',
+                               [('Content-Type', 'text/plain'),
+                                ('Allow', 'POST')])
+                return ['Method Not Allowed\r\n']
+            return self.batch(env, start_response)
+        elif env['PATH_INFO'].startswith('/check_'):
             if env['PATH_INFO'].strip('/') in self.scripts:
                 try:
                     return self.single(env, start_response)
+                except AgentBusy:
+                    start_response('503 Service Unavailable',
+                                   [('Content-Type', 'text/plain'),
+                                    ('Retry-After', str(self.retry_after))])
+                    return ['Too many checks running\r\n']
                 except Exception as err:
                     start_response('500 Internal Server Error',
                                    [('Content-Type', 'text/plain')])
@@ -177,15 +1001,153 @@ class StalkerAgent(object):
             start_response('404 Not Found', [('Content-Type', 'text/plain')])
             return ['Not Found\r\n']
 
+    def _push_check(self, script):
+        """Run a check locally and queue its result for upload"""
+        try:
+            result = self._run_check(script)
+        except AgentBusy:
+            # not a real result, just try again shortly
+            self.next_run[script] = time() + self.retry_after
+            return
+        except Exception as err:
+            self.logger.exception('Error running %s' % script)
+            result = {'status': 2, 'out': '',
+                      'err': 'Error running check: %s' % err}
+        now = time()
+        if script in self.scripts:
+            if result['status'] == 0:
+                self.next_run[script] = now + self.scripts[script]['interval']
+            else:
+                self.next_run[script] = now + \
+                    self.scripts[script]['follow_up']
+        self.push_queue.append({'check': script, 'ts': now,
+                                'status': result['status'],
+                                'out': result['out'], 'err': result['err']})
+
+    def schedule_checks(self):
+        """Push mode: run our checks on their interval (or follow_up when
+        failing) instead of waiting for the runner to call us."""
+        pool = GreenPool(self.batch_concurrency)
+        while True:
+            try:
+                now = time()
+                for script in self.next_run.keys():
+                    if script not in self.scripts:
+                        del self.next_run[script]
+                for script in self.scripts.keys():
+                    if script not in self.next_run:
+                        # stagger the first run of each check
+                        self.next_run[script] = now + \
+                            randint(0, self.scripts[script]['interval'])
+                    elif self.next_run[script] <= now:
+                        self.next_run[script] = float('inf')  # running
+                        pool.spawn_n(self._push_check, script)
+            except Exception:
+                self.logger.exception('Error scheduling checks')
+            sleep(1)
+
+    def _encode_results(self, batch):
+        """The json body for uploading batch. Results that can't be
+        serialized are logged and removed from batch (in place) so they
+        don't get requeued forever."""
+        try:
+            return json.dumps({'hostname': self.hostname, 'results': batch})
+        except (TypeError, ValueError):
+            pass
+        for result in list(batch):
+            try:
+                json.dumps(result)
+            except (TypeError, ValueError) as err:
+                self.logger.error('Dropping result for %s: %s' %
+                                  (result.get('check'), err))
+                batch.remove(result)
+        return json.dumps({'hostname': self.hostname, 'results': batch})
+
+    def _post_results(self, batch):
+        """Upload a batch of check results to stalkerweb"""
+        target = '%s/results' % (self.master_url)
+        try:
+            data = self._encode_results(batch)
+            req = urllib2.Request(target, data,
+                                  {'Content-Type': 'application/json'})
+            req.add_header("X-REGISTER-KEY", self.register_key)
+            r = urllib2.urlopen(req)
+            r.read()
+            r.close()
+            if r.code / 200 != 1:
+                self.logger.error('Error pushing results: %d status' % r.code)
+                return False
+            return True
+        except Exception as err:
+            self.logger.error('Error pushing results: %s' % err)
+            return False
+
+    def upload_results(self):
+        """Push mode: periodically upload queued results in batches"""
+        while True:
+            sleep(self.push_interval)
+            try:
+                while self.push_queue:
+                    batch = []
+                    while self.push_queue and \
+                            len(batch) < self.push_batch_size:
+                        batch.append(self.push_queue.popleft())
+                    if not self._post_results(batch):
+                        # put them back and try again next interval
+                        self.push_queue.extendleft(reversed(batch))
+                        break
+            except Exception:
+                self.logger.exception('Error uploading results')
+
+    def start_background(self):
+        """Start any background workers we're configured for"""
+        if self.push_mode:
+            eventlet.spawn_n(self.schedule_checks)
+            eventlet.spawn_n(self.upload_results)
+        if self.reload_interval:
+            eventlet.spawn_n(self.watch_scripts)
+
+    def _get_ssl_context(self):
+        """One SSLContext for all connections so TLS sessions can be
+        resumed"""
+        if not self.ssl_context:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+            context.load_cert_chain(self.ssl_crt_path, self.ssl_key_path)
+            self.ssl_context = context
+        return self.ssl_context
+
+    def connection_stats(self):
+        """How many requests and TLS handshakes reused a connection or
+        session vs. needed a new one"""
+        stats = {'new_connections': self.counters['connections'],
+                 'reused_connections': self.counters['reused_connections']}
+        if self.ssl_context:
+            sessions = self.ssl_context.session_stats()
+            stats['tls_sessions_reused'] = sessions['hits']
+            stats['tls_sessions_new'] = max(
+                0, sessions['accept_good'] - sessions['hits'])
+        return stats
+
     def start(self):
         try:
             sock = eventlet.listen((self.listen_addr, self.listen_port))
             fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
-            wsgi.server(eventlet.wrap_ssl(sock,
-                                          certfile=self.ssl_crt_path,
-                                          keyfile=self.ssl_key_path,
-                                          server_side=True),
-                        self.handle_request, log=self.request_logger)
+            if hasattr(ssl, 'SSLContext'):
+                listener = TLSListener(sock, self._get_ssl_context())
+            else:
+                listener = eventlet.wrap_ssl(sock,
+                                             certfile=self.ssl_crt_path,
+                                             keyfile=self.ssl_key_path,
+                                             server_side=True)
+
+            class Protocol(AgentHttpProtocol):
+                counters = self.counters
+
+            wsgi.server(listener, self.handle_request,
+                        log=self.request_logger, protocol=Protocol,
+                        keepalive=self.keepalive,
+                        socket_timeout=self.keepalive_timeout or None)
         except Exception:
             self.logger.exception('Oops')
             raise
@@ -196,12 +1158,8 @@ class SADaemon(Daemon):
     def run(self, conf):
         sa = StalkerAgent(conf)
         sleep(randint(1, 3))
-        while 1:
-            notified = sa.notify_master()
-            if notified:
-                break
-            else:
-                sleep(randint(1, 10))
+        sa.register()
+        sa.start_background()
         while 1:
             try:
                 sa.start()
@@ -83,15 +83,19 @@ class StatsdEvent(object):
         except Exception:
             self.logger.exception("Error sending statsd event")
 
-    def batch_gauge(self, metric_dict, prefix='stalker.'):
+    def batch_gauge(self, metric_dict, prefix='stalker.', combined=None):
         """Given a dict of metrics send all to statsd.
-           Uses alternate key prefix! Doesn't use a sample rate."""
+           Uses alternate key prefix! Doesn't use a sample rate.
+           Sends them all in one packet if combined (defaults to the
+           combined_events setting)."""
         if not self.enabled:
             return
+        if combined is None:
+            combined = self.combined_events
         payload = []
         for k in metric_dict:
-            payload.append('%s%s:%d|g' % (prefix, k, metric_dict[k]))
-        self._send_events(payload)
+            payload.append('%s%s:%s|g' % (prefix, k, metric_dict[k]))
+        self._send_events(payload, combined)
 
     def counter(self, metric_name, value=1):
         """Send a counter event"""
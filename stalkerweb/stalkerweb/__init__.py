@@ -4,7 +4,7 @@ from eventlet.green.socket import getfqdn
 from flask import Flask
 import redis
 from stalkerweb.stutils import ObjectIDConverter
-from flask_rethinkdb import RethinkDB
+from stalkerweb.rdbpool import PooledRethinkDB
 
 #: Version information (major, minor, revision[, 'dev']).
 version_info = (2, 0, 2)
@@ -32,15 +32,29 @@ app.config["RETHINKDB_HOST"] = "127.0.0.1"
 app.config["RETHINKDB_PORT"] = "28015"
 app.config["RETHINKDB_AUTH"] = "password"
 app.config["RETHINKDB_DB"] = "stalker"
+app.config["RETHINKDB_POOL_SIZE"] = 20
+app.config["RETHINKDB_POOL_TIMEOUT"] = 5
+app.config["RETHINKDB_POOL_PING"] = 30
 app.config['LOCAL_CID'] = getfqdn()
 app.config['GLOBAL_CLUSTERS'] = None
 app.config['REMOTE_TIMEOUT'] = 2
+app.config['FEDERATION_INTERVAL'] = 30
+app.config['FEDERATION_CONCURRENCY'] = 20
+app.config['FEDERATION_MAX_AGE'] = 3600
 app.config['REGISTER_KEY'] = 'itsamario'
 app.config['API_KEY'] = 'something'
 app.config['SECRET_KEY'] = 'SuperSecretDevKeyChangeMe!'
 app.config['THEMES'] = ['cosmo', 'cerulean', 'cyborg', 'slate', 'spacelab',
                         'united', 'flatly']
 app.config['CACHE_TTL'] = 10
+app.config['PUSH_GRACE'] = 60
+app.config['FLAP_THRESHOLD'] = 5
+app.config['REGISTER_RATE'] = 0
+app.config['REGISTER_BURST'] = 50
+app.config['STATE_CACHE'] = True
+app.config['SSE_KEEPALIVE'] = 15
+app.config['HOST_INDEX'] = True
+app.config['FINDHOST_LIMIT'] = 20
 app.config['GRAPHITE_ENABLE'] = False
 app.config['GRAPHITE_HOST'] = 'http://localhost/'
 app.config['LOG_FILE'] = '/var/log/stalker/stalkerweb.log'
@@ -50,7 +64,7 @@ app.config['LOG_COUNT'] = 7
 app.config.from_envvar('STALKERWEB_CONFIG', silent=True)
 
 rc = _init_redis(app)
-rdb = RethinkDB(app)
+rdb = PooledRethinkDB(app)
 
 print "== APP CONFIG FOLLOWS =="
 for i in app.config:
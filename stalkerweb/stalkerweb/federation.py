@@ -0,0 +1,127 @@
+import os
+import json
+import eventlet
+from eventlet import GreenPool
+from eventlet.green import urllib2
+from time import time
+import logging
+from stalkerweb import app, rc
+
+logger = logging.getLogger(app.config['LOG_NAME'])
+
+VALID_STATES = ['alerting', 'pending', 'in_maintenance', 'suspended']
+
+
+def get_remote_checks(clusterid, state):
+    target = app.config['GLOBAL_CLUSTERS'][clusterid]['host'] + \
+        '/checks/state/%s' % state
+    headers = {'X-API-KEY': app.config['GLOBAL_CLUSTERS'][clusterid]['key']}
+    req = urllib2.Request(target, headers=headers)
+    res = urllib2.urlopen(req, timeout=app.config['REMOTE_TIMEOUT'])
+    return json.loads(res.read())
+
+
+def get_remote_stats(clusterid):
+    target = app.config['GLOBAL_CLUSTERS'][clusterid]['host'] + '/stats'
+    headers = {'X-API-KEY': app.config['GLOBAL_CLUSTERS'][clusterid]['key']}
+    req = urllib2.Request(target, headers=headers)
+    res = urllib2.urlopen(req, timeout=app.config['REMOTE_TIMEOUT'])
+    return json.loads(res.read())[clusterid]
+
+
+class FederationPoller(object):
+    """Keeps the cache filled with every remote cluster's checks (in each
+    state) and stats, refreshing all of them in parallel every
+    FEDERATION_INTERVAL seconds. Requests answer from whatever is cached,
+    however old, and only go to the remote cluster themselves if there's
+    nothing cached yet.
+
+    Entries are cached as {'ts': fetched_at, 'data': ...} under
+    '<clusterid>:<state|stats>', and '<clusterid>:<state|stats>:meta'
+    holds the last_success/last_attempt time, consecutive error count and
+    last error for each. Only one stalkerweb process (whichever holds a
+    short lived redis lock) polls per round."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.interval = app.config['FEDERATION_INTERVAL']
+        self.pool = GreenPool(app.config['FEDERATION_CONCURRENCY'])
+        self.lock_key = 'federation:lock'
+        self.lock_id = '%s:%d' % (app.config['LOCAL_CID'], os.getpid())
+        self.thread = None
+
+    def start(self):
+        if not self.thread and app.config['GLOBAL_CLUSTERS']:
+            self.thread = eventlet.spawn(self.run)
+
+    def targets(self):
+        for clusterid in app.config['GLOBAL_CLUSTERS']:
+            for what in VALID_STATES + ['stats']:
+                yield clusterid, what
+
+    def fetch(self, clusterid, what):
+        if what == 'stats':
+            return get_remote_stats(clusterid)
+        return get_remote_checks(clusterid, what)
+
+    def refresh(self, clusterid, what):
+        """Fetch one entry and cache it (or record why we couldn't).
+        Returns the new entry or None."""
+        entry = None
+        try:
+            data = self.fetch(clusterid, what)
+            if data is None:
+                raise ValueError('empty response')
+            entry = {'ts': time(), 'data': data}
+            self.cache.set('%s:%s' % (clusterid, what), entry,
+                           timeout=app.config['FEDERATION_MAX_AGE'])
+            error = None
+        except Exception as err:
+            logger.error("Error grabbing %s for %s: %s" %
+                         (what, clusterid, err))
+            error = str(err)
+        mkey = '%s:%s:meta' % (clusterid, what)
+        info = self.cache.get(mkey) or {'last_success': None, 'errors': 0,
+                                        'last_error': None}
+        info['last_attempt'] = time()
+        if error:
+            info['errors'] += 1
+            info['last_error'] = error
+        else:
+            info['errors'] = 0
+            info['last_success'] = entry['ts']
+        self.cache.set(mkey, info, timeout=app.config['FEDERATION_MAX_AGE'])
+        return entry
+
+    def poll(self):
+        for _ in self.pool.imap(lambda t: self.refresh(*t), self.targets()):
+            pass
+
+    def run(self):
+        while True:
+            start = time()
+            try:
+                if rc.set(self.lock_key, self.lock_id, nx=True,
+                          ex=max(int(self.interval), 1)) or \
+                        rc.get(self.lock_key) == self.lock_id:
+                    self.poll()
+            except Exception:
+                logger.exception('Error polling remote clusters')
+            eventlet.sleep(max(self.interval - (time() - start), 1))
+
+    def get(self, clusterid, what):
+        """Cached entry for clusterid, fetching it inline only if we've
+        got nothing at all yet"""
+        entry = self.cache.get('%s:%s' % (clusterid, what))
+        if entry is None:
+            entry = self.refresh(clusterid, what)
+        return entry
+
+    def freshness(self, clusterid, what):
+        """How old the cached data is and how many times in a row
+        refreshing it has failed"""
+        entry = self.cache.get('%s:%s' % (clusterid, what))
+        info = self.cache.get('%s:%s:meta' % (clusterid, what)) or {}
+        return {'age': time() - entry['ts'] if entry else None,
+                'errors': info.get('errors', 0),
+                'last_error': info.get('last_error')}
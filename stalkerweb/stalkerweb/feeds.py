@@ -0,0 +1,238 @@
+import eventlet
+from bisect import bisect_left, insort
+from eventlet.queue import LightQueue, Full, Empty
+from time import time
+import logging
+import rethinkdb as r
+from stalkerweb import app
+
+logger = logging.getLogger(app.config['LOG_NAME'])
+
+
+class ChangeFeed(object):
+    """Keeps some in-process state in sync with a rethinkdb table via a
+    changefeed. The feed runs in its own greenthread on its own connection.
+    On every (re)connect the feed is opened first and then load() is called
+    to rebuild the state, so nothing that changes in between is missed.
+    Subclasses implement load(conn) and apply(old_val, new_val)."""
+
+    table = None
+
+    def __init__(self):
+        self.ready = False
+        self.synced_at = 0
+        self.last_event = 0
+        self.metrics = {'hits': 0, 'misses': 0, 'events': 0, 'reconnects': 0,
+                        'errors': 0}
+        self.thread = None
+
+    def start(self):
+        if not self.thread:
+            self.thread = eventlet.spawn(self.run)
+
+    def connect(self):
+        return r.connect(host=app.config['RETHINKDB_HOST'],
+                         port=int(app.config['RETHINKDB_PORT']),
+                         auth_key=app.config['RETHINKDB_AUTH'],
+                         db=app.config['RETHINKDB_DB'])
+
+    def run(self):
+        delay = 1
+        while True:
+            conn = None
+            try:
+                conn = self.connect()
+                feed = r.table(self.table).changes().run(conn)
+                self.load(conn)
+                self.ready = True
+                self.synced_at = time()
+                delay = 1
+                logger.info('%s synced with %s' %
+                            (self.__class__.__name__, self.table))
+                for change in feed:
+                    self.metrics['events'] += 1
+                    self.last_event = time()
+                    self.apply(change.get('old_val'), change.get('new_val'))
+            except Exception:
+                self.metrics['errors'] += 1
+                logger.exception('%s changefeed on %s failed' %
+                                 (self.__class__.__name__, self.table))
+            finally:
+                self.ready = False
+                if conn:
+                    try:
+                        conn.close(noreply_wait=False)
+                    except Exception:
+                        pass
+            self.metrics['reconnects'] += 1
+            eventlet.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def stats(self):
+        now = time()
+        stats = dict(self.metrics)
+        stats.update({'ready': self.ready,
+                      'synced_age': now - self.synced_at if self.ready
+                      else None,
+                      'last_event_age': now - self.last_event
+                      if self.last_event else None})
+        return stats
+
+    def load(self, conn):
+        raise NotImplementedError()
+
+    def apply(self, old_val, new_val):
+        raise NotImplementedError()
+
+
+class StateCache(ChangeFeed):
+    """The alerting, pending, in_maintenance and suspended sets of checks.
+    Also fans transitions (checks entering or leaving a state) out to any
+    subscribers, so every stream shares this one changefeed."""
+
+    table = 'checks'
+    # state: (index, value) for the checks in that state
+    states = {'alerting': ('status', False), 'pending': ('pending', True),
+              'in_maintenance': ('in_maintenance', True),
+              'suspended': ('suspended', True)}
+
+    def __init__(self):
+        ChangeFeed.__init__(self)
+        self.checks = dict((state, {}) for state in self.states)
+        self.subscribers = dict((state, set()) for state in self.states)
+        self.metrics['overflows'] = 0
+
+    def load(self, conn):
+        checks = {}
+        for state, (index, value) in self.states.iteritems():
+            checks[state] = dict((c['id'], c) for c in r.table(
+                self.table).get_all(value, index=index).run(conn))
+        self.checks = checks
+        for state in self.states:
+            self.publish(state, 'snapshot', None)
+
+    def apply(self, old_val, new_val):
+        for state, (field, value) in self.states.iteritems():
+            was = old_val and self.checks[state].pop(old_val['id'], None)
+            if new_val and new_val.get(field) is value:
+                self.checks[state][new_val['id']] = new_val
+                if not was:
+                    self.publish(state, 'entered', new_val)
+            elif was:
+                self.publish(state, 'left', {'id': was['id'],
+                                             'hostname': was['hostname'],
+                                             'check': was['check']})
+
+    def subscribe(self, state, maxsize=1000):
+        """A queue that gets (event, check) for every check that enters or
+        leaves state, and ('snapshot', None) whenever the subscriber should
+        (re)read the whole set"""
+        queue = LightQueue(maxsize)
+        self.subscribers[state].add(queue)
+        return queue
+
+    def unsubscribe(self, state, queue):
+        self.subscribers[state].discard(queue)
+
+    def publish(self, state, event, check):
+        for queue in self.subscribers[state]:
+            try:
+                queue.put_nowait((event, check))
+            except Full:
+                # slow subscriber, throw away its backlog and have it
+                # start over from a snapshot instead
+                self.metrics['overflows'] += 1
+                try:
+                    while True:
+                        queue.get_nowait()
+                except Empty:
+                    pass
+                queue.put_nowait(('snapshot', None))
+
+    def get(self, state):
+        """Checks in state, or None if we're not in sync right now"""
+        if not self.ready:
+            self.metrics['misses'] += 1
+            return None
+        self.metrics['hits'] += 1
+        return self.checks[state].values()
+
+    def stats(self):
+        stats = ChangeFeed.stats(self)
+        stats['sizes'] = dict((s, len(c)) for s, c in self.checks.items())
+        stats['subscribers'] = dict((s, len(q)) for s, q in
+                                    self.subscribers.items())
+        return stats
+
+
+class HostIndex(ChangeFeed):
+    """Sorted in-memory index of every registered hostname and ip for
+    prefix lookups (i.e. the /findhost typeahead). Entries are kept per
+    host id, so changes that load() already saw and the feed replays
+    afterwards are no-ops."""
+
+    table = 'hosts'
+
+    def __init__(self):
+        ChangeFeed.__init__(self)
+        self.hosts = {}
+        self.keys = []
+        self.counts = {}
+
+    def _add(self, key):
+        if not key:
+            return
+        if key not in self.counts:
+            self.counts[key] = 0
+            insort(self.keys, key)
+        self.counts[key] += 1
+
+    def _remove(self, key):
+        if key not in self.counts:
+            return
+        self.counts[key] -= 1
+        if not self.counts[key]:
+            del self.counts[key]
+            del self.keys[bisect_left(self.keys, key)]
+
+    def load(self, conn):
+        hosts = {}
+        counts = {}
+        for host in r.table(self.table).pluck('id', 'hostname',
+                                              'ip').run(conn):
+            hosts[host['id']] = (host.get('hostname'), host.get('ip'))
+            for key in hosts[host['id']]:
+                if key:
+                    counts[key] = counts.get(key, 0) + 1
+        self.hosts = hosts
+        self.counts = counts
+        self.keys = sorted(counts)
+
+    def apply(self, old_val, new_val):
+        hid = (new_val or old_val)['id']
+        for key in self.hosts.pop(hid, ()):
+            self._remove(key)
+        if new_val:
+            self.hosts[hid] = (new_val.get('hostname'), new_val.get('ip'))
+            for key in self.hosts[hid]:
+                self._add(key)
+
+    def lookup(self, prefix, limit):
+        """Up to limit hostnames/ips starting with prefix, or None if we're
+        not in sync right now"""
+        if not self.ready:
+            self.metrics['misses'] += 1
+            return None
+        self.metrics['hits'] += 1
+        result = []
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and len(result) < limit and \
+                self.keys[i].startswith(prefix):
+            result.append(self.keys[i])
+            i += 1
+        return result
+
+    def stats(self):
+        stats = ChangeFeed.stats(self)
+        stats['size'] = len(self.keys)
+        return stats
@@ -0,0 +1,133 @@
+from collections import deque
+from time import time
+from flask import _app_ctx_stack as stack
+from eventlet.semaphore import Semaphore
+import rethinkdb as r
+from rethinkdb.errors import RqlDriverError
+
+
+class ConnectionPool(object):
+    """A bounded pool of rethinkdb connections for use from greenthreads.
+
+    At most size connections exist at once, get() waits up to timeout
+    seconds for one to free up. Connections that have been sitting idle for
+    more than ping_interval seconds get pinged before being handed out, and
+    closed ones get reconnected."""
+
+    def __init__(self, connect, size=20, timeout=5, ping_interval=30):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.slots = Semaphore(size)
+        self.idle = deque()
+        self.metrics = {'checkouts': 0, 'waits': 0, 'wait_time': 0.0,
+                        'max_wait': 0.0, 'timeouts': 0, 'created': 0,
+                        'reconnects': 0, 'discarded': 0}
+
+    def _healthy(self, conn, last_used):
+        if not conn.is_open():
+            return False
+        if time() - last_used > self.ping_interval:
+            try:
+                r.expr(1).run(conn)
+            except Exception:
+                return False
+        return True
+
+    def get(self):
+        start = time()
+        if not self.slots.acquire(blocking=False):
+            self.metrics['waits'] += 1
+            if not self.slots.acquire(timeout=self.timeout):
+                self.metrics['timeouts'] += 1
+                raise RqlDriverError('Timed out waiting for a connection')
+        waited = time() - start
+        self.metrics['checkouts'] += 1
+        self.metrics['wait_time'] += waited
+        self.metrics['max_wait'] = max(self.metrics['max_wait'], waited)
+        try:
+            if self.idle:
+                conn, last_used = self.idle.pop()
+                if not self._healthy(conn, last_used):
+                    self.metrics['reconnects'] += 1
+                    conn.reconnect(noreply_wait=False)
+                return conn
+            conn = self.connect()
+            self.metrics['created'] += 1
+            return conn
+        except Exception:
+            self.slots.release()
+            raise
+
+    def put(self, conn, discard=False):
+        """Return a connection to the pool, or close it if discard"""
+        try:
+            if discard or not conn.is_open():
+                self.metrics['discarded'] += 1
+                try:
+                    conn.close(noreply_wait=False)
+                except Exception:
+                    pass
+            else:
+                self.idle.append((conn, time()))
+        finally:
+            self.slots.release()
+
+    def stats(self):
+        stats = dict(self.metrics)
+        stats.update({'size': self.size, 'idle': len(self.idle),
+                      'in_use': self.size - self.slots.counter,
+                      'avg_wait': self.metrics['wait_time'] /
+                      self.metrics['checkouts']
+                      if self.metrics['checkouts'] else 0.0})
+        return stats
+
+
+class PooledRethinkDB(object):
+    """Stands in for flask_rethinkdb's RethinkDB: rdb.conn is a connection
+    for the current app context, only now it's checked out of a
+    ConnectionPool and goes back to it at teardown (closed instead if the
+    request died on a driver error)."""
+
+    def __init__(self, app=None):
+        self.pool = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RETHINKDB_HOST', 'localhost')
+        app.config.setdefault('RETHINKDB_PORT', '28015')
+        app.config.setdefault('RETHINKDB_AUTH', '')
+        app.config.setdefault('RETHINKDB_DB', None)
+        app.config.setdefault('RETHINKDB_POOL_SIZE', 20)
+        app.config.setdefault('RETHINKDB_POOL_TIMEOUT', 5)
+        app.config.setdefault('RETHINKDB_POOL_PING', 30)
+        self.app = app
+        self.pool = ConnectionPool(self.connect,
+                                   app.config['RETHINKDB_POOL_SIZE'],
+                                   app.config['RETHINKDB_POOL_TIMEOUT'],
+                                   app.config['RETHINKDB_POOL_PING'])
+        app.teardown_appcontext(self.teardown)
+
+    def connect(self):
+        return r.connect(host=self.app.config['RETHINKDB_HOST'],
+                         port=int(self.app.config['RETHINKDB_PORT']),
+                         auth_key=self.app.config['RETHINKDB_AUTH'],
+                         db=self.app.config['RETHINKDB_DB'])
+
+    @property
+    def conn(self):
+        ctx = stack.top
+        if ctx is not None:
+            if not hasattr(ctx, 'rethinkdb'):
+                ctx.rethinkdb = self.pool.get()
+            return ctx.rethinkdb
+
+    def teardown(self, exception):
+        ctx = stack.top
+        conn = getattr(ctx, 'rethinkdb', None)
+        if conn is not None:
+            del ctx.rethinkdb
+            self.pool.put(conn, discard=isinstance(exception,
+                                                   RqlDriverError))
@@ -4,6 +4,7 @@ from base64 import urlsafe_b64encode, urlsafe_b64decode
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
 import datetime
+import time
 import mmh3
 
 try:
@@ -34,6 +35,33 @@ def jsonify(data):
                     mimetype='application/json')
 
 
+def iter_json(key, docs, trailer=None):
+    """Yield {key: [doc, ...]} as JSON a doc at a time. trailer is called
+    once all docs have been sent and may return a dict of extra top level
+    fields to include."""
+    yield '{%s: [' % json.dumps(key)
+    sep = ''
+    for doc in docs:
+        yield sep + json.dumps(doc, cls=APIEncoder)
+        sep = ', '
+    yield ']'
+    for k, v in (trailer() if trailer else {}).items():
+        yield ', %s: %s' % (json.dumps(k), json.dumps(v, cls=APIEncoder))
+    yield '}'
+
+
+def sse(event, data):
+    """Format a server-sent event"""
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data,
+                                                          cls=APIEncoder))
+
+
+def iter_ndjson(docs):
+    """Yield docs as newline delimited JSON"""
+    for doc in docs:
+        yield json.dumps(doc, cls=APIEncoder) + '\n'
+
+
 class ObjectIDConverter(BaseConverter):
 
     def to_python(self, value):
@@ -50,3 +78,30 @@ class ObjectIDConverter(BaseConverter):
 
 def genPrimaryKey64(data):
     return "%x" % (mmh3.hash128(data) & 0xFFFFFFFFFFFFFFFF)
+
+
+class TokenBucket(object):
+    """Simple token bucket rate limiter. Holds up to burst tokens and
+    refills at rate tokens per second. A rate of 0 disables limiting."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def consume(self, count=1):
+        """Take count tokens. Returns 0 if they were available, otherwise
+        the number of seconds until they would be (nothing is taken).
+        More than burst tokens are never available at once, so callers
+        need to turn those requests away themselves."""
+        if not self.rate:
+            return 0
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= count:
+            self.tokens -= count
+            return 0
+        return (count - self.tokens) / self.rate
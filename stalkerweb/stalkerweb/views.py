@@ -1,14 +1,20 @@
-import json
+import re
 import eventlet
 eventlet.monkey_patch()
-from eventlet.green import urllib2
-from flask import request, abort, render_template, session, redirect
+from eventlet import GreenPool
+from flask import request, abort, render_template, session, redirect, \
+    Response, stream_with_context
 from bson import ObjectId
 from time import time
 from random import randint
+from math import ceil
 from stalkerweb.auth import is_valid_login, login_required, remove_user
-from stalkerweb.stutils import jsonify, genPrimaryKey64
+from eventlet.queue import Empty
+from stalkerweb.stutils import jsonify, genPrimaryKey64, TokenBucket, \
+    iter_json, iter_ndjson, sse
 from stalkerweb import app, rc, rdb
+from stalkerweb.feeds import StateCache, HostIndex
+from stalkerweb.federation import FederationPoller, VALID_STATES
 from flask.ext.wtf import Form
 from wtforms import TextField, PasswordField, BooleanField
 from wtforms.validators import Required
@@ -17,12 +23,28 @@ import rethinkdb as r
 from rethinkdb.errors import RqlDriverError, RqlRuntimeError
 import logging
 
-VALID_STATES = ['alerting', 'pending', 'in_maintenance', 'suspended']
-
 cache = RedisCache(host=app.config['REDIS_HOST'], port=app.config['REDIS_PORT'], default_timeout=app.config['CACHE_TTL'])
 
 logger = logging.getLogger(app.config['LOG_NAME'])
 
+register_limiter = TokenBucket(app.config['REGISTER_RATE'],
+                               app.config['REGISTER_BURST'])
+
+state_cache = StateCache() if app.config['STATE_CACHE'] else None
+
+host_index = HostIndex() if app.config['HOST_INDEX'] else None
+
+federation = FederationPoller(cache)
+
+
+@app.before_first_request
+def _start_feeds():
+    if state_cache:
+        state_cache.start()
+    if host_index:
+        host_index.start()
+    federation.start()
+
 
 class SignInForm(Form):
     username = TextField(validators=[Required()])
@@ -44,35 +66,6 @@ def _get_local_metrics():
         return None
 
 
-def _get_remote_checks(clusterid, state):
-    endpoints = {'alerting': '/checks/state/alerting',
-                 'pending': '/checks/state/pending',
-                 'suspended': '/checks/state/suspended',
-                 'in_maintenance': '/checks/state/in_maintenance'}
-    target = app.config['GLOBAL_CLUSTERS'][clusterid]['host'] + \
-        endpoints[state]
-    headers = {'X-API-KEY': app.config['GLOBAL_CLUSTERS'][clusterid]['key']}
-    try:
-        req = urllib2.Request(target, headers=headers)
-        res = urllib2.urlopen(req, timeout=app.config['REMOTE_TIMEOUT'])
-        return json.loads(res.read())
-    except Exception as err:
-        logger.exception("Error grabbing checks for %s: %s" % (clusterid, err))
-        return None
-
-
-def _get_remote_stats(clusterid):
-    target = app.config['GLOBAL_CLUSTERS'][clusterid]['host'] + '/stats'
-    headers = {'X-API-KEY': app.config['GLOBAL_CLUSTERS'][clusterid]['key']}
-    try:
-        req = urllib2.Request(target, headers=headers)
-        res = urllib2.urlopen(req, timeout=app.config['REMOTE_TIMEOUT'])
-        return json.loads(res.read())[clusterid]
-    except Exception as err:
-        logger.exception("Error grabbing stats for %s: %s" % (clusterid, err))
-        return None
-
-
 def _get_users_theme(username):
     q = list(r.table("users").filter({"username": username}).pluck({"theme": True}).run(rdb.conn))[0]
     return q.get('theme', 'cerulean')
@@ -100,6 +93,8 @@ def _valid_registration(content):
             return False
         if not isinstance(content['checks'][check]['interval'], int):
             return False
+        if 'follow_up' not in content['checks'][check]:
+            return False
         if not isinstance(content['checks'][check]['follow_up'], int):
             return False
         if 'args' not in content['checks'][check]:
@@ -109,50 +104,339 @@ def _valid_registration(content):
                 return False
         if not isinstance(content['checks'][check]['args'], basestring):
             return False
+    if 'config_hash' in content:
+        if not isinstance(content['config_hash'], basestring):
+            return False
     # everything checked out
     return True
 
 
+# check fields that come from the agent, everything else (status, owner,
+# fail counts, schedule) belongs to stalkerd/users and survives registration
+REGISTERED_CHECK_FIELDS = ('interval', 'follow_up', 'priority')
+
+
+def _check_fields(check):
+    return {'interval': check['interval'],
+            'follow_up': check['follow_up'],
+            'priority': check.get('priority', 1)}
+
+
+def _registration_host(content):
+    """The hosts table doc for a (valid) registration payload"""
+    ip_addr = content.get('ip', request.remote_addr)
+    if ip_addr == '':
+        ip_addr = request.remote_addr
+    return {'id': genPrimaryKey64("%s%s" % (content['hostname'], ip_addr)),
+            'hostname': content['hostname'],
+            'ip': ip_addr,
+            'checks': content['checks'],
+            'roles': content['roles'],
+            'config_hash': content.get('config_hash')}
+
+
+def _register_hosts(hosts):
+    """Apply a list of registrations (hosts table docs). Only the
+    difference between what the agents sent and what we already have gets
+    written: new checks are added, checks whose interval/follow_up/priority
+    changed are updated, checks an agent no longer has are removed and
+    everything else is left alone. Hosts that send the same config_hash
+    as last time are skipped entirely. However many hosts there are this
+    is at most one read and one write per table plus one delete."""
+    stats = {'hosts': len(hosts), 'unchanged': 0, 'added': 0, 'updated': 0,
+             'removed': 0}
+    hashed = [h['id'] for h in hosts if h['config_hash']]
+    if hashed:
+        stored = dict((h['id'], h['config_hash']) for h in
+                      r.table("hosts").get_all(*hashed).pluck(
+                          'id', 'config_hash').run(rdb.conn))
+        changed = [h for h in hosts if not h['config_hash'] or
+                   stored.get(h['id']) != h['config_hash']]
+        stats['unchanged'] = len(hosts) - len(changed)
+        hosts = changed
+    if not hosts:
+        return stats
+    q = r.table("hosts").insert(hosts, conflict="replace").run(rdb.conn)
+    hostnames = list(set(h['hostname'] for h in hosts))
+    existing = dict((c['id'], c) for c in r.table("checks").get_all(
+        *hostnames, index="hostname").pluck(
+        'id', *REGISTERED_CHECK_FIELDS).run(rdb.conn))
+    bulk_load = []
+    for host in hosts:
+        hid = host['hostname']
+        checks = host['checks']
+        for i in checks:
+            cid = genPrimaryKey64("%s%s%s" % (hid, host['ip'], i))
+            fields = _check_fields(checks[i])
+            if cid not in existing:
+                fields.update({'id': cid, 'hostname': hid, 'ip': host['ip'],
+                               'check': i, 'last': 0, 'next': _rand_start(),
+                               'pending': False, 'status': None,
+                               'in_maintenance': False, 'suspended': False,
+                               'out': ''})
+                bulk_load.append(fields)
+                stats['added'] += 1
+                continue
+            current = existing.pop(cid)
+            if any(current.get(k) != fields[k] for k in fields):
+                fields['id'] = cid
+                bulk_load.append(fields)
+                stats['updated'] += 1
+    if bulk_load:
+        q = r.table("checks").insert(bulk_load,
+                                     conflict="update").run(rdb.conn)
+    if existing:
+        q = r.table("checks").get_all(*existing.keys()).delete().run(
+            rdb.conn)
+        stats['removed'] = len(existing)
+    return stats
+
+
+def _register_throttled(count=1):
+    """If registering count hosts right now would put us over
+    REGISTER_RATE, return the 429 response to send back instead"""
+    wait = register_limiter.consume(count)
+    if not wait:
+        return None
+    resp = jsonify({'status': 'fail', 'error': 'Too many registrations'})
+    resp.status_code = 429
+    resp.headers['Retry-After'] = str(int(ceil(wait)))
+    return resp
+
+
 @app.route("/register", methods=['POST', 'PUT'])
 def register():
+    """Register (or re-register) a host and its checks"""
     if request.headers.get('X-REGISTER-KEY') != app.config['REGISTER_KEY']:
         abort(412)
     if not request.json:
         abort(400)
     if not _valid_registration(request.json):
         abort(400)
+    throttled = _register_throttled()
+    if throttled:
+        return throttled
+    try:
+        stats = _register_hosts([_registration_host(request.json)])
+    except Exception as err:
+        logger.error(err)
+        return jsonify({'status': 'fail', 'error': str(err)}), 400
+    if stats['unchanged']:
+        return jsonify({'status': 'ok', 'unchanged': True})
+    return jsonify({'status': 'ok', 'added': stats['added'],
+                    'updated': stats['updated'], 'removed': stats['removed']})
+
+
+@app.route("/register/batch", methods=['POST', 'PUT'])
+def register_batch():
+    """Register many hosts in one go (i.e. from a relay that registers
+    a whole rack). Expects {"hosts": [registration, ...]} where each
+    registration looks like what /register takes (ip should be set since
+    the source ip is the relay's). Invalid registrations are skipped and
+    reported back by their position in the list."""
+    if request.headers.get('X-REGISTER-KEY') != app.config['REGISTER_KEY']:
+        abort(412)
+    if not request.json:
+        abort(400)
+    if not isinstance(request.json.get('hosts'), list):
+        abort(400)
+    hosts = {}
+    invalid = []
+    for i, content in enumerate(request.json['hosts']):
+        if not isinstance(content, dict) or not _valid_registration(content):
+            invalid.append(i)
+            continue
+        host = _registration_host(content)
+        hosts[host['id']] = host  # last registration for a host wins
+    if app.config['REGISTER_RATE'] and \
+            len(hosts) > app.config['REGISTER_BURST']:
+        return jsonify({'status': 'fail',
+                        'error': 'Batch larger than REGISTER_BURST'}), 413
+    throttled = _register_throttled(len(hosts))
+    if throttled:
+        return throttled
+    try:
+        stats = _register_hosts(hosts.values())
+    except Exception as err:
+        logger.error(err)
+        return jsonify({'status': 'fail', 'error': str(err)}), 400
+    stats.update({'status': 'ok', 'invalid': invalid})
+    return jsonify(stats)
+
+
+def _valid_results(content):
+    if not isinstance(content.get('hostname'), basestring):
+        return False
+    if not isinstance(content.get('results'), list):
+        return False
+    fields = [('check', basestring), ('status', int), ('out', basestring),
+              ('err', basestring), ('ts', (int, float))]
+    for result in content['results']:
+        if not isinstance(result, dict):
+            return False
+        for field in fields:
+            if not isinstance(result.get(field[0]), field[1]):
+                return False
+    return True
+
+
+@app.route("/results", methods=['POST'])
+def results():
+    """Check results uploaded by agents running in push mode. Passing
+    results for checks that were already passing are applied here. Anything
+    else (failures, state changes, new checks) gets rescheduled for now so
+    stalkerd re-runs it and handles alerting/flap detection/state logging as
+    usual."""
+    if request.headers.get('X-REGISTER-KEY') != app.config['REGISTER_KEY']:
+        abort(412)
+    if not request.json:
+        abort(400)
+    if not _valid_results(request.json):
+        abort(400)
     hid = request.json['hostname']
-    checks = request.json['checks']
-    roles = request.json['roles']
     ip_addr = request.json.get('ip', request.remote_addr)
     if ip_addr == '':
         ip_addr = request.remote_addr
+    # only the most recent result for a check matters
+    latest = {}
+    for result in sorted(request.json['results'], key=lambda k: k['ts']):
+        latest[genPrimaryKey64("%s%s%s" % (hid, ip_addr,
+                                           result['check']))] = result
+    updates = []
+    handoff = []
+    if not latest:
+        return jsonify({'status': 'ok', 'applied': 0, 'rescheduled': 0})
     try:
-        pkey = genPrimaryKey64("%s%s" % (hid, ip_addr))
-        q = r.table("hosts").insert({
-                "id": pkey,
-                "hostname": hid,
-                "ip": ip_addr,
-                "checks": checks,
-                "roles": roles
-            },conflict="update").run(rdb.conn)
-        q = r.table("checks").filter({"hostname": hid}).delete().run(rdb.conn) #we're about to reinstart all so just delete all incase checks got removed
-        bulk_load = []
-        for i in checks:
-            bulk_load.append({'id': genPrimaryKey64("%s%s%s" % (hid, ip_addr, i)),
-                              'hostname': hid, 'ip': ip_addr,
-                              'check': i, 'last': 0, 'next': _rand_start(),
-                              'interval': checks[i]['interval'],
-                              'follow_up': checks[i]['follow_up'],
-                              'pending': False,
-                              'status': None, 'in_maintenance': False,
-                              'suspended': False, 'out': '',
-                              'priority': checks[i].get('priority', 1)})
-            q = r.table("checks").insert(bulk_load, conflict="update").run(rdb.conn)
+        for check in r.table("checks").get_all(*latest.keys()).run(rdb.conn):
+            result = latest[check['id']]
+            if result['status'] == 0 and check['status'] is True:
+                flapid = 'flap:%s:%s' % (check['hostname'], check['check'])
+                flapping = int(rc.get(flapid) or 0) >= \
+                    app.config['FLAP_THRESHOLD']
+                updates.append({'id': check['id'], 'pending': False,
+                                'status': True, 'flapping': flapping,
+                                'last': int(result['ts']),
+                                'next': int(result['ts']) + check['interval'] +
+                                app.config['PUSH_GRACE'],
+                                'out': result['out'] + result['err'],
+                                'fail_count': 0})
+            elif not check['pending']:
+                handoff.append({'id': check['id'], 'next': time() - 1})
+        if updates or handoff:
+            r.table("checks").insert(updates + handoff,
+                                     conflict="update").run(rdb.conn)
     except Exception as err:
         logger.error(err)
         return jsonify({'status': 'fail', 'error': str(err)}), 400
-    return jsonify({'status': 'ok'})
+    return jsonify({'status': 'ok', 'applied': len(updates),
+                    'rescheduled': len(handoff)})
+
+
+# query args that make a check listing something other than the whole set
+CHECK_QUERY_ARGS = set(['fields', 'priority', 'owner', 'flapping', 'role'])
+
+
+def _fields():
+    """The fields asked for via ?fields=a,b,c (None means everything)"""
+    if not request.args.get('fields'):
+        return None
+    return [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+
+
+def _check_filter(predicate=None):
+    """Build a filter for checks from ?priority=, ?owner=, ?flapping= and
+    ?role= (and'd together with predicate, if given) so the database does
+    the filtering. An empty owner matches unclaimed checks."""
+    preds = [] if predicate is None else [predicate]
+    try:
+        if 'priority' in request.args:
+            preds.append(r.row['priority'] == int(request.args['priority']))
+    except ValueError:
+        abort(400)
+    if 'owner' in request.args:
+        preds.append(r.row['owner'].default('') == request.args['owner'])
+    if 'flapping' in request.args:
+        flapping = request.args['flapping'].lower() in ('true', '1', 'yes')
+        preds.append(r.row['flapping'].default(False) == flapping)
+    if 'role' in request.args:
+        hostnames = list(r.table("hosts").filter(
+            r.row["roles"].contains(request.args['role']))["hostname"].run(
+            rdb.conn))
+        preds.append(r.expr(hostnames).contains(r.row['hostname']))
+    if not preds:
+        return None
+    return reduce(lambda a, b: a & b, preds)
+
+
+def _listing(table, key, predicate=None, fields=None, hide_id=False,
+             selection=None):
+    """List the docs in table (matching predicate if given), optionally a
+    page at a time and/or streamed straight from the cursor.
+
+    ?limit=N returns at most N docs ordered by primary key along with a
+    next_marker, pass that back as ?marker= to get the next page.
+    ?stream=json sends the same JSON document but writes it out as the
+    cursor is read instead of building it in memory first, ?stream=ndjson
+    sends one doc per line. Unpaginated, unstreamed listings 404 when
+    nothing matches, like they always have. If fields is given only those
+    fields are fetched. Pass a (small) selection to list it instead of the
+    whole table, it gets paged by sorting on id in the database."""
+    try:
+        limit = int(request.args.get('limit', 0))
+    except ValueError:
+        abort(400)
+    marker = request.args.get('marker')
+    stream = request.args.get('stream')
+    if limit < 0 or stream not in (None, 'json', 'ndjson'):
+        abort(400)
+    paged = bool(limit or marker)
+    if selection is not None:
+        q = selection
+        if paged:
+            if marker:
+                q = q.filter(r.row['id'] > marker)
+            q = q.order_by('id')
+    else:
+        q = r.table(table)
+        if paged:
+            if marker:
+                q = q.between(marker, r.maxval, left_bound='open')
+            q = q.order_by(index='id')
+    if predicate is not None:
+        q = q.filter(predicate)
+    if limit:
+        q = q.limit(limit)
+    if fields:
+        q = q.pluck('id', *fields)  # we need the id for next_marker
+        hide_id = hide_id or 'id' not in fields
+    last = {'id': None, 'count': 0}
+
+    def docs():
+        for doc in q.run(rdb.conn):
+            last['id'] = doc['id']
+            last['count'] += 1
+            if hide_id:
+                del doc['id']
+            yield doc
+
+    def next_marker():
+        if limit and last['count'] == limit:
+            return last['id']
+        return None
+
+    if stream == 'ndjson':
+        return Response(stream_with_context(iter_ndjson(docs())),
+                        mimetype='application/x-ndjson')
+    if stream == 'json':
+        trailer = (lambda: {'next_marker': next_marker()}) if paged else None
+        return Response(stream_with_context(iter_json(key, docs(), trailer)),
+                        mimetype='application/json')
+    result = list(docs())
+    if paged:
+        return jsonify({key: result, 'next_marker': next_marker()})
+    if not result:
+        abort(404)
+    return jsonify({key: result})
 
 
 @app.route("/user/", defaults={'username': None})
@@ -200,18 +484,19 @@ def users(username):
 @app.route("/hosts/<host>", methods=['GET', 'DELETE'])
 @login_required
 def hosts(host):
-    """Delete a given host and all its checks"""
+    """List all hosts, get a given host or delete it and all its checks"""
     if not host:
-        q = list(r.table("hosts").without("id").run(rdb.conn))
-        if q:
-            q = {'hosts': q}
+        return _listing("hosts", "hosts", hide_id=True)
     else:
         if request.method == 'DELETE':
-            q = r.table("checks").filter((r.row["hostname"] == host) | (r.row["ip"] == host)).delete().run(rdb.conn)
-            q = r.table("hosts").filter((r.row["hostname"] == host) | (r.row["ip"] == host)).delete().run(rdb.conn)
+            q = r.table("checks").get_all(host, index="hostname").delete().run(rdb.conn)
+            q = r.table("checks").get_all(host, index="ip").delete().run(rdb.conn)
+            q = r.table("hosts").get_all(host, index="hostname").delete().run(rdb.conn)
+            q = r.table("hosts").get_all(host, index="ip").delete().run(rdb.conn)
             return jsonify({'success': True})
         else:
-            q = list(r.table("hosts").filter((r.row["hostname"] == host) | (r.row["ip"] == host)).without("id").run(rdb.conn))
+            q = list(r.table("hosts").get_all(host, index="hostname").union(
+                r.table("hosts").get_all(host, index="ip")).without("id").run(rdb.conn))
     if q:
         return jsonify(q[0])
     else:
@@ -222,17 +507,13 @@ def hosts(host):
 @app.route("/checks/host/<host>")
 @login_required
 def checks(host):
-    """Get all checks for a given hostname or ip"""
+    """Get all checks, or all checks for a given hostname or ip"""
     if not host:
-        q = list(r.table("checks").run(rdb.conn))
+        return _listing("checks", "checks", _check_filter(), _fields())
     else:
-        q = list(r.table("checks").filter((r.row["hostname"] == host) | (r.row["ip"] == host)).run(rdb.conn))
-    if q:
-        for check in q:
-            check['id'] = str(check['id'])
-        return jsonify({'checks': q})
-    else:
-        abort(404)
+        return _listing("checks", "checks", _check_filter(), _fields(),
+                        selection=r.table("checks").get_all(host, index="hostname").union(
+                            r.table("checks").get_all(host, index="ip")).distinct())
 
 
 @app.route('/checks/id/<checkid>', methods=['GET', 'DELETE'])
@@ -247,8 +528,15 @@ def checks_by_id(checkid):
         else:
             abort(404)
     elif request.method == 'DELETE':
-        q = r.table("checks").get(checkid).delete().run(rdb.conn)
+        q = r.table("checks").get(checkid).delete(
+            return_changes=True).run(rdb.conn)
         if q["deleted"] == 1:
+            # make the owning host's next registration a full one so the
+            # check comes back if the agent still has it
+            check = q['changes'][0]['old_val']
+            pkey = genPrimaryKey64("%s%s" % (check['hostname'], check['ip']))
+            r.table("hosts").get(pkey).update(
+                {'config_hash': None}).run(rdb.conn)
             return jsonify({'success': True})
         else:
             return jsonify({'success': False})
@@ -354,36 +642,71 @@ def check_suspended(checkid):
             abort(400)
 
 
+def _local_state(state):
+    """All local checks in state, from the state cache if we can"""
+    if state_cache:
+        cached = state_cache.get(state)
+        if cached is not None:
+            return cached
+    index, value = StateCache.states[state]
+    return list(r.table("checks").get_all(value, index=index).run(rdb.conn))
+
+
 @app.route('/checks/state/<state>')
 @login_required
 def check_state(state):
-    """List of checks in cluster in a given state [alerting/pending/suspended]"""
-    if state == 'alerting':
-        q = list(r.table("checks").get_all(False, index="status").run(rdb.conn))
-        if q:
-            return jsonify({'alerting': q})
-        else:
-            return jsonify({'alerting': []})
-    elif state == 'pending':
-        q = list(r.table("checks").get_all(True, index="pending").run(rdb.conn))
-        if q:
-            return jsonify({'pending': q})
-        else:
-            return jsonify({'pending': []})
-    elif state == 'in_maintenance':
-        q = list(r.table("checks").get_all(True, index="in_maintenance").run(rdb.conn))
-        if q:
-            return jsonify({'in_maintenance': q})
-        else:
-            return jsonify({'in_maintenance': []})
-    elif state == 'suspended':
-        q = list(r.table("checks").get_all(True, index="suspended").run(rdb.conn))
-        if q:
-            return jsonify({'suspended': q})
-        else:
-            return jsonify({'suspended': []})
-    else:
+    """List of checks in cluster in a given state [alerting/pending/suspended]
+    Takes the same ?fields= and filter args as /checks/"""
+    indexes = StateCache.states
+    if state not in indexes:
         abort(400)
+    if not (set(request.args) & CHECK_QUERY_ARGS):
+        return jsonify({state: _local_state(state)})
+    index, value = indexes[state]
+    q = r.table("checks").get_all(value, index=index)
+    predicate = _check_filter()
+    if predicate is not None:
+        q = q.filter(predicate)
+    fields = _fields()
+    if fields:
+        q = q.pluck(*fields)
+    return jsonify({state: list(q.run(rdb.conn))})
+
+
+@app.route('/checks/state/<state>/stream')
+@login_required
+def check_state_stream(state):
+    """Server-sent events for checks in a given state. Sends a snapshot
+    event with all checks in the state, then entered/left events as checks
+    change state. Another snapshot is sent if we had to resync."""
+    if state not in StateCache.states:
+        abort(400)
+    if not state_cache:
+        abort(404)
+    queue = state_cache.subscribe(state)
+
+    def events():
+        try:
+            yield 'retry: 5000\n\n'
+            if state_cache.ready:
+                yield sse('snapshot', state_cache.checks[state].values())
+            while True:
+                try:
+                    event, check = queue.get(
+                        timeout=app.config['SSE_KEEPALIVE'])
+                except Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if event == 'snapshot':
+                    check = state_cache.checks[state].values()
+                yield sse(event, check)
+        finally:
+            state_cache.unsubscribe(state, queue)
+
+    return Response(stream_with_context(events()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 
 @app.route('/state_log/<hostname>/<checkname>', methods=['GET'])
@@ -395,7 +718,10 @@ def state_log_by_check(hostname, checkname):
             limit = request.args.get('limit', 10, type=int)
         except ValueError:
             abort(400)
-        log = list(r.table("state_log").filter({"hostname": hostname, "check": checkname}).order_by(r.desc("last")).limit(limit).run(rdb.conn))
+        log = list(r.table("state_log").between(
+            [hostname, checkname, r.minval], [hostname, checkname, r.maxval],
+            index="hostname_check_last").order_by(
+            index=r.desc("hostname_check_last")).limit(limit).run(rdb.conn))
         if log:
             return jsonify({'state_log': sorted(log, key=lambda k: k['last'])})
         else:
@@ -415,7 +741,10 @@ def list_notes(hostname):
             limit = request.args.get('limit', 50, type=int)
         except ValueError:
             abort(400)
-        notes = list(r.table("notes").filter({"hostname": hostname}).order_by(r.desc("ts")).limit(limit).run(rdb.conn))
+        notes = list(r.table("notes").between(
+            [hostname, r.minval], [hostname, r.maxval],
+            index="hostname_ts").order_by(
+            index=r.desc("hostname_ts")).limit(limit).run(rdb.conn))
         if notes:
             return jsonify({'notes': sorted(notes, key=lambda k: k['ts'])})
         else:
@@ -427,7 +756,7 @@ def list_notes(hostname):
             abort(400)
         if not r.table("hosts").get_all(hostname, index="hostname").run(rdb.conn):
             abort(404)
-        alerting = [x["check"] for x in r.table("checks").filter({"h stname": hostname, "status": False}).run(rdb.conn)]
+        alerting = [x["check"] for x in r.table("checks").get_all([hostname, False], index="hostname_status").run(rdb.conn)]
         q = r.table("notes").insert({'hostname': hostname, 'user': request.json.get("user"),
                                      'note': request.json.get("note"), 'ts': time(), 'alerting': alerting}).run(rdb.conn)
         if q["inserted"] == 1:
@@ -446,33 +775,72 @@ def global_clusters():
     return jsonify({'clusters': app.config['GLOBAL_CLUSTERS']})
 
 
+def _remote_clusters():
+    return app.config['GLOBAL_CLUSTERS'] or {}
+
+
 @app.route('/global/<clusterid>/checks/state/<state>')
 @login_required
 def global_check_state(clusterid, state):
-    """Get a list of all checks in provided state for a given cluster"""
-    if clusterid not in app.config['GLOBAL_CLUSTERS']:
+    """Get a list of all checks in provided state for a given cluster, as
+    last fetched by the federation poller. freshness has how old that is
+    and how many refreshes in a row have failed since."""
+    if clusterid not in _remote_clusters():
         abort(400)
     if state in VALID_STATES:
-        ckey = '%s:%s' % (clusterid, state)
-        cached = cache.get(ckey)
-        if cached:
-            return jsonify({clusterid: cached})
-        else:
-            q = _get_remote_checks(clusterid, state)
-        if q:
-            cache.set(ckey, q)
-            return jsonify({clusterid: q})
+        entry = federation.get(clusterid, state)
+        if entry:
+            return jsonify({clusterid: entry['data'],
+                            'freshness': {clusterid: federation.freshness(
+                                clusterid, state)}})
         else:
             abort(500)
     else:
         abort(400)
 
 
+@app.route('/global/all/checks/state/<state>')
+@login_required
+def global_all_check_state(state):
+    """Checks in the provided state across the local and all remote
+    clusters in one list, each tagged with its cluster and sorted by
+    cluster then hostname. Remote clusters come from the federation
+    poller's cache (fetched in parallel if not cached yet), freshness has
+    how old each one's data is. Clusters we have no data for at all are
+    left out of checks and show up in freshness with their last error."""
+    if state not in VALID_STATES:
+        abort(400)
+    local = app.config['LOCAL_CID']
+    merged = []
+    for check in _local_state(state):
+        check = dict(check)
+        check['cluster'] = local
+        merged.append(check)
+    freshness = {local: {'age': 0, 'errors': 0, 'last_error': None}}
+    cids = _remote_clusters().keys()
+    entries = GreenPool(len(cids) or 1).imap(
+        lambda cid: federation.get(cid, state), cids)
+    for cid, entry in zip(cids, entries):
+        freshness[cid] = federation.freshness(cid, state)
+        if not entry:
+            continue
+        for check in entry['data'].get(state, []):
+            check = dict(check)
+            if '_id' in check:
+                check['id'] = check.pop('_id')
+            check['cluster'] = cid
+            merged.append(check)
+    merged.sort(key=lambda k: (k['cluster'], k.get('hostname'),
+                               k.get('check')))
+    return jsonify({state: merged, 'freshness': freshness})
+
+
 @app.route('/stats', defaults={'clusterid': None})
 @app.route('/stats/<clusterid>')
 @login_required
 def stalker_stats(clusterid):
-    """Obtain stats for this cluster or one with a given clusterid"""
+    """Obtain stats for this cluster or one with a given clusterid. Remote
+    stats come from the federation poller, with their freshness."""
     default = {'qsize': None, 'failing': None, 'flapping': None,
                'suspended': None, 'checks': None, 'pending': None}
     if not clusterid:
@@ -482,52 +850,65 @@ def stalker_stats(clusterid):
         else:
             return jsonify({app.config['LOCAL_CID']: default})
     else:
-        if clusterid in app.config['GLOBAL_CLUSTERS']:
-            ckey = '%s:%s' % (clusterid, 'stats')
-            cached = cache.get(ckey)
-            if cached:
-                return jsonify({clusterid: cached})
-            else:
-                q = _get_remote_stats(clusterid)
-                if q:
-                    cache.set(ckey, q)
-                    return jsonify({clusterid: q})
-                else:
-                    return jsonify({clusterid: default})
+        if clusterid in _remote_clusters():
+            entry = federation.get(clusterid, 'stats')
+            return jsonify({clusterid: entry['data'] if entry else default,
+                            'freshness': {clusterid: federation.freshness(
+                                clusterid, 'stats')}})
         elif clusterid == 'all':
             q = {}
+            freshness = {}
             q[app.config['LOCAL_CID']] = _get_local_metrics()
-            for cid in app.config['GLOBAL_CLUSTERS'].keys():
-                ckey = '%s:%s' % (cid, 'stats')
-                cached = cache.get(ckey)
-                if cached:
-                    q[cid] = cached
-                else:
-                    q[cid] = _get_remote_stats(cid)
-                    if not q[cid]:
-                        q[cid] = default
-                    cache.set(ckey, q[cid])
-            return jsonify({'all': q})
+            cids = _remote_clusters().keys()
+            # anything not cached yet gets fetched in parallel
+            entries = GreenPool(len(cids) or 1).imap(
+                lambda cid: federation.get(cid, 'stats'), cids)
+            for cid, entry in zip(cids, entries):
+                q[cid] = entry['data'] if entry else default
+                freshness[cid] = federation.freshness(cid, 'stats')
+            return jsonify({'all': q, 'freshness': freshness})
         else:
             abort(404)
 
 
+@app.route('/internal/stats')
+@login_required
+def internal_stats():
+    """Stats about this stalkerweb process's in-memory caches and its
+    rethinkdb connection pool"""
+    return jsonify({'state_cache': state_cache.stats() if state_cache
+                    else None,
+                    'host_index': host_index.stats() if host_index
+                    else None,
+                    'rethinkdb_pool': rdb.pool.stats()})
+
+
 @app.route('/findhost')
 @login_required
 def findhost():
-    """Just used for the type ahead"""
-    # probably should cache hosts in memcached/redis for type ahead crap
-    if not request.args.get('q'):
+    """Just used for the type ahead. Returns up to ?limit= (default
+    FINDHOST_LIMIT) hostnames/ips starting with ?q="""
+    query = request.args.get('q')
+    if not query:
+        abort(400)
+    try:
+        limit = int(request.args.get('limit', app.config['FINDHOST_LIMIT']))
+    except ValueError:
         abort(400)
-    result = []
+    if host_index:
+        result = host_index.lookup(query, limit)
+        if result is not None:
+            return ",".join(result)
+    result = set()
+    prefix = "^%s" % re.escape(query)
     for i in r.table("hosts").filter(
-            r.row["hostname"].match("^%s" % request.args.get('q')) | r.row["ip"].match("^%s" % request.args.get('q'))
-            ).pluck({"hostname": True, "ip": True}).run(rdb.conn):
-        if i['hostname'].startswith(request.args.get('q')):
-            result.append(i['hostname'])
+            r.row["hostname"].match(prefix) | r.row["ip"].match(prefix)
+            ).pluck({"hostname": True, "ip": True}).limit(limit).run(rdb.conn):
+        if i['hostname'].startswith(query):
+            result.add(i['hostname'])
         else:
-            result.append(i['ip'])
-    return ",".join(result)
+            result.add(i['ip'])
+    return ",".join(sorted(result))
 
 
 @app.route('/')
@@ -1,10 +1,121 @@
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import time
 import unittest
+from collections import OrderedDict
+
+try:
+    from StringIO import StringIO
+    import eventlet
+    from stalkeragent import stalker_agent
+except (ImportError, SyntaxError):
+    # the agent needs python 2 and eventlet
+    stalker_agent = None
+
+needs_agent = unittest.skipIf(stalker_agent is None,
+                              'stalkeragent not importable')
+
+
+class StopLoop(Exception):
+    pass
+
+
+def unicode_plugin(args):
+    return {'status': 0, 'out': u'caf\xe9', 'err': 42}
+
+
+def slow_plugin(args):
+    time.sleep(float(args[0]))
+    return {'status': 0, 'out': 'done'}
+
+
+def running(pid):
+    """Is pid still around (and not just a zombie)"""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
 
 class TestStalkerAgent(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.script_dir = os.path.join(self.tmp, 'scripts')
+        os.mkdir(self.script_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def agent(self, checks=None, **conf):
+        main = {'log_path': os.path.join(self.tmp, 'agent.log'),
+                'script_dir': self.script_dir}
+        main.update(conf)
+        fullconf = {'main': main}
+        fullconf.update(checks or {})
+        return stalker_agent.StalkerAgent(fullconf)
+
+    def script(self, name, body):
+        path = os.path.join(self.script_dir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n%s\n' % body)
+        os.chmod(path, 0o755)
+        return path
+
+    def patch_sleep(self, loops):
+        """Make the agent's sleep() end a loop after it's called loops
+        times, yielding to other greenthreads in the meantime"""
+        calls = []
+
+        def fake_sleep(seconds):
+            calls.append(seconds)
+            eventlet.sleep(0)
+            if len(calls) >= loops:
+                raise StopLoop()
+
+        orig = stalker_agent.sleep
+        stalker_agent.sleep = fake_sleep
+        self.addCleanup(setattr, stalker_agent, 'sleep', orig)
+        return calls
+
+    def call(self, app, body=None):
+        body = json.dumps(body) if body is not None else ''
+        env = {'CONTENT_LENGTH': str(len(body)), 'wsgi.input': StringIO(body)}
+        status = []
+        out = ''.join(app(env, lambda s, h: status.append(s)))
+        return status[0], out
+
     def test___init__(self):
         # stalker_agent = StalkerAgent(fullconf)
         assert True # TODO: implement your test here
 
+    @needs_agent
+    def test_batch(self):
+        self.script('check_slow', 'sleep 0.5; echo slow')
+        self.script('check_fast', 'echo fast')
+        agent = self.agent()
+        status, body = self.call(agent.batch, {'checks': [
+            'check_slow', 'check_fast', 'check_fast', 'check_nope']})
+        self.assertEqual('200 OK', status)
+        results = json.loads(body, object_pairs_hook=OrderedDict)
+        self.assertEqual(['check_fast', 'check_nope', 'check_slow'],
+                         sorted(results))
+        # streamed as they finish, not in request order
+        self.assertEqual('check_slow', list(results)[-1])
+        self.assertEqual('fast', results['check_fast']['out'])
+        self.assertEqual('No such check', results['check_nope']['err'])
+        status, body = self.call(agent.batch, {'checks': 'all'})
+        self.assertEqual(['check_fast', 'check_slow'],
+                         sorted(json.loads(body)))
+        for bad in ({'checks': ['check_fast', {'a': 1}]},
+                    {'checks': 'check_fast'}, {'nope': []}, None):
+            status, body = self.call(agent.batch, bad)
+            self.assertEqual('400 Bad Request', status)
+
     def test_handle_request(self):
         # stalker_agent = StalkerAgent(fullconf)
         # self.assertEqual(expected, stalker_agent.handle_request(env, start_response))
@@ -15,16 +126,358 @@ class TestStalkerAgent(unittest.TestCase):
         # self.assertEqual(expected, stalker_agent.notify_master())
         assert True # TODO: implement your test here
 
+    @needs_agent
+    def test_register(self):
+        agent = self.agent(register_backoff='1', register_backoff_max='300')
+        attempts = []
+
+        def notify_master():
+            attempts.append(1)
+            # master asks for a minute on the first try
+            agent.master_retry_after = 60 if len(attempts) == 1 else None
+            return len(attempts) > 1100
+
+        agent.notify_master = notify_master
+        delays = self.patch_sleep(2000)
+        agent.register()
+        self.assertEqual(1100, len(delays))
+        self.assertTrue(60.5 <= delays[0] <= 61)
+        self.assertTrue(1 <= delays[1] <= 2)
+        self.assertTrue(all(d <= 300 for d in delays[1:]))
+        self.assertTrue(all(d >= 150 for d in delays[10:]))
+
+    @needs_agent
+    def test_reload_checks(self):
+        check_a = self.script('check_a', 'true')
+        agent = self.agent()
+        agent._run_check('check_a')
+        self.assertFalse(agent.reload_checks())
+        self.assertEqual(['check_a'], list(agent.check_stats))
+        os.unlink(check_a)
+        self.script('check_b', 'true')
+        self.assertTrue(agent.reload_checks())
+        self.assertEqual(['check_b'], list(agent.scripts))
+        self.assertEqual({}, agent.check_stats)
+
+    @needs_agent
+    def test_run_check(self):
+        runs = os.path.join(self.tmp, 'runs')
+        self.script('check_a', 'echo run >> %s; sleep 0.2; echo OK' % runs)
+        with open(os.path.join(self.script_dir, 'check_a.cfg'), 'w') as f:
+            f.write('[default]\nmax_age = 60\n')
+        agent = self.agent()
+        # concurrent calls share a single run
+        calls = [eventlet.spawn(agent._run_check, 'check_a')
+                 for _ in range(3)]
+        results = [c.wait() for c in calls]
+        self.assertEqual([0, 0, 0], [x['status'] for x in results])
+        self.assertTrue(results[0] is results[1] is results[2])
+        # and later ones get the cached result until max_age is up
+        self.assertTrue(agent._run_check('check_a') is results[0])
+        with open(runs) as f:
+            self.assertEqual(1, len(f.readlines()))
+        self.assertEqual(1, agent.check_stats['check_a'].runs)
+        self.assertEqual({}, agent.inflight)
+
+    @needs_agent
+    def test_plugin_output(self):
+        agent = self.agent({'check_plugin': {
+            'module': '%s:unicode_plugin' % __name__}})
+        result = agent._run_check('check_plugin')
+        self.assertEqual((0, u'caf\xe9', u'42'),
+                         (result['status'], result['out'], result['err']))
+        json.dumps(result)
+
+    @needs_agent
+    def test_load_shedding(self):
+        self.script('check_a', 'true')
+        self.script('check_b', 'true')
+        agent = self.agent(max_inflight='1', max_queued='1',
+                           queue_timeout='0.2', retry_after='7')
+        held = agent._acquire_slot('check_b')
+        waiter = eventlet.spawn(agent._batch_result, 'check_a')
+        eventlet.sleep(0)
+        # the queue is full, so this one is turned away right away
+        headers = {}
+
+        def start_response(status, response_headers):
+            headers.update(response_headers, status=status)
+
+        env = {'PATH_INFO': '/check_b', 'HTTP_X_CHECK_KEY': agent.check_key}
+        self.assertEqual(['Too many checks running\r\n'],
+                         agent.handle_request(env, start_response))
+        self.assertEqual('503 Service Unavailable', headers['status'])
+        self.assertEqual('7', headers['Retry-After'])
+        # and the queued one gives up after queue_timeout
+        self.assertEqual('Agent busy, check shed', waiter.wait()[1]['err'])
+        self.assertEqual(2, agent.counters['shed'])
+        self.assertEqual(1, agent.counters['queued'])
+        self.assertEqual(1, agent.check_stats['check_a'].shed)
+        self.assertEqual(1, agent.check_stats['check_b'].shed)
+        self.assertEqual(0, agent.check_stats['check_a'].runs)
+        agent._release_slot(held)
+        self.assertEqual(0, agent._run_check('check_a')['status'])
+
+    @needs_agent
+    def test_timeout(self):
+        pidfile = os.path.join(self.tmp, 'pid')
+        self.script('check_hangs', 'sleep 30 & echo $! > %s; wait' % pidfile)
+        with open(os.path.join(self.script_dir, 'check_hangs.cfg'),
+                  'w') as f:
+            f.write('[default]\ntimeout = 1\n')
+        agent = self.agent()
+        started = time.time()
+        result = agent._run_check('check_hangs')
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual(2, result['status'])
+        self.assertEqual('Check timed out after 1s', result['err'])
+        self.assertEqual(1, agent.counters['timed_out'])
+        self.assertEqual(agent.max_inflight, agent.slots.counter)
+        # whatever the check started went down with it
+        with open(pidfile) as f:
+            pid = int(f.read())
+        eventlet.sleep(0.1)
+        self.assertFalse(running(pid))
+
+    @needs_agent
+    def test_hung_plugin(self):
+        agent = self.agent({'check_slow': {
+            'module': '%s:slow_plugin' % __name__, 'args': '2',
+            'timeout': '1'}}, max_inflight='2')
+        result = agent._run_check('check_slow')
+        self.assertEqual('Check timed out after 1s', result['err'])
+        # the thread is still running, so it keeps its slot
+        self.assertEqual(1, agent.slots.counter)
+        self.assertEqual(['check_slow'], list(agent.plugin_calls))
+        self.assertEqual(1, agent.check_stats['check_slow'].in_flight)
+        result = agent._run_check('check_slow')
+        self.assertEqual(3, result['status'])
+        self.assertEqual('Previous call of plugin still running',
+                         result['err'])
+        self.assertEqual(1, agent.slots.counter)
+        eventlet.sleep(1.5)
+        self.assertEqual(2, agent.slots.counter)
+        self.assertEqual({}, agent.plugin_calls)
+        self.assertEqual(0, agent.check_stats['check_slow'].in_flight)
+
+    @needs_agent
+    def test_schedule_checks(self):
+        self.script('check_a', 'true')
+        self.script('check_b', 'true')
+        agent = self.agent(default_interval='60')
+        ran = []
+        agent._push_check = ran.append
+        agent.next_run = {'check_a': 0, 'check_gone': 0}
+        self.patch_sleep(1)
+        start = stalker_agent.time()
+        self.assertRaises(StopLoop, agent.schedule_checks)
+        self.assertEqual(['check_a'], ran)
+        self.assertEqual(['check_a', 'check_b'], sorted(agent.next_run))
+        self.assertEqual(float('inf'), agent.next_run['check_a'])
+        self.assertTrue(start <= agent.next_run['check_b'] <= start + 61)
+
+    @needs_agent
     def test_single(self):
-        # stalker_agent = StalkerAgent(fullconf)
-        # self.assertEqual(expected, stalker_agent.single(env, start_response))
-        assert True # TODO: implement your test here
+        # 100 two byte characters, cut mid character on both sides
+        self.script('check_accents', "for i in $(seq 100); "
+                    "do printf '\\303\\251'; done")
+        agent = self.agent(max_output_bytes='10')
+        status = []
+        body = ''.join(agent.single({'PATH_INFO': '/check_accents'},
+                                    lambda s, h: status.append(s)))
+        self.assertEqual(['200 OK'], status)
+        result = json.loads(body)['check_accents']
+        self.assertTrue(result['truncated'])
+        self.assertEqual(u'\xe9\xe9\ufffd\n[...truncated...]\n'
+                         u'\ufffd\xe9\xe9', result['out'])
 
     def test_start(self):
         # stalker_agent = StalkerAgent(fullconf)
         # self.assertEqual(expected, stalker_agent.start())
         assert True # TODO: implement your test here
 
+    @needs_agent
+    def test_stats(self):
+        self.script('check_a', 'exit 2')
+        agent = self.agent(max_inflight='1')
+        agent._run_check('check_a')
+        held = agent._acquire_slot('check_b')
+        waiter = eventlet.spawn(agent._acquire_slot, 'check_a')
+        eventlet.sleep(0)
+        status, body = self.call(agent.stats)
+        self.assertEqual('200 OK', status)
+        stats = json.loads(body)
+        self.assertEqual(1, stats['in_flight'])
+        self.assertEqual(1, stats['queued'])
+        check_a = stats['checks']['check_a']
+        self.assertEqual((1, 1), (check_a['runs'], check_a['failures']))
+        # check_a is waiting for check_b's slot
+        self.assertEqual((0, 1), (check_a['in_flight'], check_a['queued']))
+        self.assertEqual((1, 0), (stats['checks']['check_b']['in_flight'],
+                                  stats['checks']['check_b']['queued']))
+        agent._release_slot(held)
+        agent._release_slot(waiter.wait())
+        stats = json.loads(self.call(agent.stats)[1])
+        self.assertEqual(0, stats['in_flight'])
+        self.assertEqual(0, stats['queued'])
+        self.assertEqual((0, 0), (stats['checks']['check_a']['in_flight'],
+                                  stats['checks']['check_a']['queued']))
+
+    @needs_agent
+    def test_upload_results(self):
+        agent = self.agent(push_batch_size='2')
+        agent.push_queue.extend({'check': 'check_%d' % i} for i in range(5))
+        posted = []
+
+        def post(batch):
+            posted.append([x['check'] for x in batch])
+            return len(posted) < 3
+
+        agent._post_results = post
+        self.patch_sleep(2)
+        self.assertRaises(StopLoop, agent.upload_results)
+        self.assertEqual([['check_0', 'check_1'], ['check_2', 'check_3'],
+                          ['check_4']], posted)
+        # the failed batch waits for the next round
+        self.assertEqual([{'check': 'check_4'}], list(agent.push_queue))
+
+    @needs_agent
+    def test_upload_bad_results(self):
+        agent = self.agent()
+        batch = [{'check': 'check_ok', 'out': 'fine'},
+                 {'check': 'check_bad', 'out': 'caf\xe9'}]
+        body = json.loads(agent._encode_results(batch))
+        self.assertEqual([{'check': 'check_ok', 'out': 'fine'}],
+                         body['results'])
+        self.assertEqual(['check_ok'], [x['check'] for x in batch])
+        # the loops log errors and carry on
+        agent.push_queue.append({'check': 'check_ok'})
+
+        def post(batch):
+            raise RuntimeError('boom')
+
+        agent._post_results = post
+        agent.scripts = None
+        self.patch_sleep(3)
+        self.assertRaises(StopLoop, agent.upload_results)
+        self.patch_sleep(3)
+        self.assertRaises(StopLoop, agent.schedule_checks)
+
+@needs_agent
+class TestHeadTailBuffer(unittest.TestCase):
+    def test_under_limit(self):
+        buf = stalker_agent.HeadTailBuffer(10)
+        buf.write('abc')
+        buf.write('defghij')
+        self.assertEqual('abcdefghij', buf.getvalue())
+        self.assertFalse(buf.truncated)
+
+    def test_keeps_head_and_tail(self):
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        big = stalker_agent.HeadTailBuffer(10)
+        big.write(letters)
+        small = stalker_agent.HeadTailBuffer(10)
+        for c in letters:
+            small.write(c)
+        for buf in (big, small):
+            self.assertTrue(buf.truncated)
+            self.assertEqual('abcde\n[...truncated...]\nvwxyz',
+                             buf.getvalue())
+            self.assertEqual(5, buf.tail_len)
+
+    def test_multibyte(self):
+        buf = stalker_agent.HeadTailBuffer(10)
+        buf.write(u'\xe9'.encode('utf-8') * 100)
+        self.assertEqual(u'\xe9\xe9\ufffd\n[...truncated...]\n'
+                         u'\ufffd\xe9\xe9', buf.getvalue())
+        buf = stalker_agent.HeadTailBuffer(10)
+        buf.write('caf\xe9')  # latin-1, not utf-8
+        self.assertEqual(u'caf\ufffd', buf.getvalue())
+
+@needs_agent
+class TestParsePerfdata(unittest.TestCase):
+    def metric(self, label, value, unit='', warn=None, crit=None, min=None,
+               max=None):
+        return {'label': label, 'value': value, 'unit': unit, 'warn': warn,
+                'crit': crit, 'min': min, 'max': max}
+
+    def test_parse_perfdata(self):
+        parse_perfdata = stalker_agent.parse_perfdata
+        self.assertEqual([], parse_perfdata('OK - no perfdata here'))
+        self.assertEqual(
+            [self.metric('/', 2643.0, 'MB', 5948.0, 5958.0, 0.0, 5968.0),
+             self.metric('free space', 40.0, '%'),
+             self.metric('load', 1.5)],
+            parse_perfdata("DISK OK | /=2643MB;5948;5958;0;5968 "
+                           "'free space'=40% load=1.5"))
+
+    def test_multiline(self):
+        # the example from the nagios plugin development guidelines
+        output = ("DISK OK - free space: / 3326 MB (56%); | "
+                  "/=2643MB;5948;5958;0;5968\n"
+                  "/ 15272 MB (77%);\n"
+                  "/boot 68 MB (69%);\n"
+                  "/home 69357 MB (27%);\n"
+                  "/var/log 819 MB (84%); | /boot=68MB;88;93;0;98\n"
+                  "/home=69357MB;253404;253409;0;253414\n"
+                  "/var/log=818MB;970;975;0;980\n")
+        self.assertEqual(
+            [self.metric('/', 2643.0, 'MB', 5948.0, 5958.0, 0.0, 5968.0),
+             self.metric('/boot', 68.0, 'MB', 88.0, 93.0, 0.0, 98.0),
+             self.metric('/home', 69357.0, 'MB', 253404.0, 253409.0, 0.0,
+                         253414.0),
+             self.metric('/var/log', 818.0, 'MB', 970.0, 975.0, 0.0, 980.0)],
+            stalker_agent.parse_perfdata(output))
+        # long text without perfdata of its own
+        self.assertEqual(
+            [self.metric('a', 1.0)],
+            stalker_agent.parse_perfdata('OK | a=1\nfree=10 means nothing'))
+
+    def test_ranges_and_junk(self):
+        self.assertEqual(
+            [self.metric('x', 5.0, warn='10:20', crit='@30:40'),
+             self.metric('z', -1.5)],
+            stalker_agent.parse_perfdata('WARN | x=5;10:20;@30:40 y=abc '
+                                         'z=-1.5'))
+
+@needs_agent
+class TestParseSize(unittest.TestCase):
+    def test_parse_size(self):
+        parse_size = stalker_agent.parse_size
+        self.assertEqual(512, parse_size('512'))
+        self.assertEqual(4096, parse_size('4k'))
+        self.assertEqual(512 * 1024 ** 2, parse_size(' 512M '))
+        self.assertEqual(2 * 1024 ** 3, parse_size('2G'))
+        self.assertRaises(ValueError, parse_size, 'lots')
+
+@needs_agent
+class TestChildLimits(unittest.TestCase):
+    def test___init__(self):
+        ChildLimits = stalker_agent.ChildLimits
+        self.assertEqual(ChildLimits(), ChildLimits(ionice_class='none'))
+        self.assertNotEqual(ChildLimits(), ChildLimits(nice=5))
+        res = stalker_agent.resource
+        self.assertEqual([], ChildLimits(rlimits={res.RLIMIT_CPU:
+                                                  None}).rlimits)
+        hard = res.getrlimit(res.RLIMIT_NOFILE)[1]
+        if hard != res.RLIM_INFINITY:
+            self.assertEqual([(res.RLIMIT_NOFILE, hard)], ChildLimits(
+                rlimits={res.RLIMIT_NOFILE: hard + 100}).rlimits)
+        self.assertRaises(ValueError, ChildLimits, ionice_class='fast')
+        self.assertRaises(ValueError, ChildLimits, ionice_class='idle',
+                          ionice_level=8)
+
+    def test___call__(self):
+        res = stalker_agent.resource
+        limits = stalker_agent.ChildLimits(
+            nice=5, rlimits={res.RLIMIT_NOFILE: 64})
+        script = ('import os, resource; print os.getsid(0) == os.getpid(), '
+                  'os.nice(0), resource.getrlimit(resource.RLIMIT_NOFILE)')
+        out = subprocess.check_output([sys.executable, '-c', script],
+                                      preexec_fn=limits)
+        self.assertEqual('True %d (64, 64)' % min(os.nice(0) + 5, 19),
+                         out.strip())
+
 class TestSADaemon(unittest.TestCase):
     def test_run(self):
         # s_a_daemon = SADaemon()
@@ -0,0 +1,97 @@
+import unittest
+
+try:
+    from stalkerweb import feeds
+except (ImportError, SyntaxError):
+    # stalkerweb needs python 2 and its requirements installed
+    feeds = None
+
+needs_stalkerweb = unittest.skipIf(feeds is None,
+                                   'stalkerweb not importable')
+
+
+def host(hostname, ip):
+    return {'id': hostname + ip, 'hostname': hostname, 'ip': ip}
+
+
+class FakeTable(object):
+    """r.table(...).pluck(...).run(conn) returning docs"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def table(self, name):
+        return self
+
+    def pluck(self, *fields):
+        return self
+
+    def run(self, conn):
+        return [dict(doc) for doc in self.docs]
+
+
+@needs_stalkerweb
+class TestHostIndex(unittest.TestCase):
+    def index(self, *hosts):
+        index = feeds.HostIndex()
+        for doc in hosts:
+            index.apply(None, doc)
+        index.ready = True
+        return index
+
+    def load(self, *hosts):
+        self.addCleanup(setattr, feeds, 'r', feeds.r)
+        feeds.r = FakeTable(hosts)
+        index = feeds.HostIndex()
+        index.load(None)
+        index.ready = True
+        return index
+
+    def test_lookup(self):
+        index = self.index(host('web1', '10.0.0.1'),
+                           host('web2', '10.0.0.2'),
+                           host('db1', '10.0.1.1'))
+        self.assertEqual(['web1', 'web2'], index.lookup('web', 10))
+        self.assertEqual(['web1'], index.lookup('web', 1))
+        self.assertEqual(['10.0.0.1', '10.0.0.2'],
+                         index.lookup('10.0.0', 10))
+        self.assertEqual([], index.lookup('mail', 10))
+        self.assertEqual(6, len(index.lookup('', 10)))
+
+    def test_apply(self):
+        # the same hostname registered from two ips
+        old = host('web1', '10.0.0.1')
+        moved = host('web1', '10.0.0.9')
+        index = self.index(old, moved)
+        index.apply(old, None)
+        self.assertEqual(['web1'], index.lookup('web', 10))
+        self.assertEqual(['10.0.0.9'], index.lookup('10.', 10))
+        index.apply(moved, dict(moved, hostname='www1'))
+        self.assertEqual([], index.lookup('web', 10))
+        self.assertEqual(['www1'], index.lookup('w', 10))
+        self.assertEqual(['10.0.0.9', 'www1'], index.keys)
+
+    def test_replay(self):
+        # changes made between opening the feed and load() show up in
+        # both, replaying them mustn't count anything twice
+        web1 = host('web1', '10.0.0.1')
+        other = host('web1', '10.0.0.2')
+        gone = host('db1', '10.0.1.1')
+        index = self.load(web1, other)
+        index.apply(None, web1)  # inserted just before load()
+        index.apply(gone, None)  # deleted just before load()
+        index.apply(web1, None)
+        self.assertEqual(['web1'], index.lookup('web', 10))
+        self.assertEqual(['10.0.0.2'], index.lookup('10.', 10))
+        index.apply(other, None)
+        self.assertEqual([], index.lookup('', 10))
+        self.assertEqual({}, index.counts)
+
+    def test_not_ready(self):
+        index = self.index(host('web1', '10.0.0.1'))
+        index.ready = False
+        self.assertEqual(None, index.lookup('web', 10))
+        self.assertEqual(1, index.metrics['misses'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+
+try:
+    from stalkerweb import stutils
+except (ImportError, SyntaxError):
+    # stalkerweb needs python 2 and its requirements installed
+    stutils = None
+
+needs_stalkerweb = unittest.skipIf(stutils is None,
+                                   'stalkerweb not importable')
+
+
+@needs_stalkerweb
+class TestTokenBucket(unittest.TestCase):
+    def test_disabled(self):
+        bucket = stutils.TokenBucket(0, 5)
+        self.assertEqual(0, bucket.consume(1000))
+
+    def test_consume(self):
+        bucket = stutils.TokenBucket(10, 5)
+        self.assertEqual(0, bucket.consume(5))
+        self.assertAlmostEqual(0.1, bucket.consume(), places=2)
+        # nothing was taken, so the wait doesn't grow
+        self.assertAlmostEqual(0.1, bucket.consume(), places=2)
+        bucket.last -= 1  # a second later it's full again
+        self.assertEqual(0, bucket.consume(5))
+
+    def test_consume_more_than_burst(self):
+        bucket = stutils.TokenBucket(10, 50)
+        self.assertAlmostEqual(1.0, bucket.consume(60), places=2)
+        self.assertEqual(50, bucket.tokens)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import json
+import unittest
+
+try:
+    from stalkerweb import app, views
+except (ImportError, SyntaxError):
+    # stalkerweb needs python 2 and its requirements installed
+    views = None
+
+needs_stalkerweb = unittest.skipIf(views is None,
+                                   'stalkerweb not importable')
+
+
+class FakeRethinkDB(object):
+    """Just enough of the rethinkdb query api for registration, backed by
+    dicts. Every query that gets run is logged in ops."""
+
+    def __init__(self):
+        self.tables = {'hosts': {}, 'checks': {}}
+        self.ops = []
+
+    def table(self, name):
+        return FakeQuery(self, name, 'table', [])
+
+
+class FakeQuery(object):
+    def __init__(self, db, table, op, docs):
+        self.db = db
+        self.table = table
+        self.op = op
+        self.docs = docs
+
+    def get_all(self, *keys, **kwargs):
+        index = kwargs.get('index', 'id')
+        return FakeQuery(self.db, self.table, 'get_all', [
+            doc for doc in self.db.tables[self.table].values()
+            if doc.get(index) in keys])
+
+    def pluck(self, *fields):
+        return FakeQuery(self.db, self.table, self.op, [
+            dict((k, doc[k]) for k in fields if k in doc)
+            for doc in self.docs])
+
+    def insert(self, docs, conflict):
+        return FakeQuery(self.db, self.table, 'insert', docs)
+
+    def delete(self):
+        return FakeQuery(self.db, self.table, 'delete', self.docs)
+
+    def run(self, conn):
+        self.db.ops.append((self.table, self.op, len(self.docs)))
+        table = self.db.tables[self.table]
+        for doc in self.docs:
+            if self.op == 'delete':
+                del table[doc['id']]
+            elif self.op == 'insert':
+                table.setdefault(doc['id'], {}).update(doc)
+        return self.docs
+
+
+def registration(hostname, checks):
+    return {'hostname': hostname, 'ip': '10.0.0.1', 'roles': ['server'],
+            'checks': checks}
+
+
+@needs_stalkerweb
+class TestRegisterHosts(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeRethinkDB()
+        self.addCleanup(setattr, views, 'r', views.r)
+        views.r = self.db
+
+    def host(self, hostname, checks, config_hash=None):
+        return {'id': views.genPrimaryKey64(hostname + '10.0.0.1'),
+                'hostname': hostname, 'ip': '10.0.0.1', 'roles': ['server'],
+                'checks': checks, 'config_hash': config_hash}
+
+    def register(self, *hosts):
+        self.db.ops = []
+        return views._register_hosts(list(hosts))
+
+    def checks(self, hostname):
+        return dict((c['check'], c) for c in self.db.tables['checks'].values()
+                    if c['hostname'] == hostname)
+
+    def test_diff(self):
+        check = {'interval': 60, 'follow_up': 30, 'priority': 1}
+        stats = self.register(self.host('a', {'c1': check, 'c2': check}),
+                              self.host('b', {'c1': check}))
+        self.assertEqual({'hosts': 2, 'unchanged': 0, 'added': 3,
+                          'updated': 0, 'removed': 0}, stats)
+        self.assertEqual(['c1', 'c2'], sorted(self.checks('a')))
+        self.assertEqual(None, self.checks('a')['c1']['status'])
+        self.checks('a')['c1']['status'] = True
+        # registering the same checks again doesn't touch them
+        stats = self.register(self.host('a', {'c1': check, 'c2': check}))
+        self.assertEqual(0, stats['added'] + stats['updated'] +
+                         stats['removed'])
+        self.assertEqual([('hosts', 'insert', 1), ('checks', 'get_all', 2)],
+                         self.db.ops)
+        # only what changed gets written, check state is kept
+        changed = dict(check, interval=120)
+        stats = self.register(self.host('a', {'c1': changed, 'c3': check}))
+        self.assertEqual({'hosts': 1, 'unchanged': 0, 'added': 1,
+                          'updated': 1, 'removed': 1}, stats)
+        checks = self.checks('a')
+        self.assertEqual(['c1', 'c3'], sorted(checks))
+        self.assertEqual(120, checks['c1']['interval'])
+        self.assertTrue(checks['c1']['status'])
+        self.assertEqual(['c1'], sorted(self.checks('b')))
+
+    def test_config_hash(self):
+        check = {'interval': 60, 'follow_up': 30}
+        self.register(self.host('a', {'c1': check}, 'abc'))
+        stats = self.register(self.host('a', {'c1': check}, 'abc'))
+        self.assertEqual(1, stats['unchanged'])
+        self.assertEqual([('hosts', 'get_all', 1)], self.db.ops)
+        stats = self.register(self.host('a', {'c2': check}, 'def'))
+        self.assertEqual((0, 1, 1), (stats['unchanged'], stats['added'],
+                                     stats['removed']))
+        self.assertEqual(['c2'], sorted(self.checks('a')))
+
+
+@needs_stalkerweb
+class TestRegisterBatch(unittest.TestCase):
+    def post(self, body):
+        headers = {'X-REGISTER-KEY': app.config['REGISTER_KEY']}
+        with app.test_request_context('/register/batch', method='POST',
+                                      data=json.dumps(body), headers=headers,
+                                      content_type='application/json'):
+            return app.make_response(views.register_batch())
+
+    def test_larger_than_burst(self):
+        self.addCleanup(setattr, views, 'register_limiter',
+                        views.register_limiter)
+        views.register_limiter = views.TokenBucket(10, 2)
+        rate = app.config['REGISTER_RATE'], app.config['REGISTER_BURST']
+        self.addCleanup(app.config.update, REGISTER_RATE=rate[0],
+                        REGISTER_BURST=rate[1])
+        app.config.update(REGISTER_RATE=10, REGISTER_BURST=2)
+        hosts = [registration('host%d' % i, {}) for i in range(3)]
+        resp = self.post({'hosts': hosts})
+        self.assertEqual(413, resp.status_code)
+        # and a batch that fits is only throttled by the rate
+        views.register_limiter.tokens = 0
+        resp = self.post({'hosts': hosts[:2]})
+        self.assertEqual(429, resp.status_code)
+        self.assertEqual('1', resp.headers['Retry-After'])
+
+if __name__ == '__main__':
+    unittest.main()